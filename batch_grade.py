@@ -0,0 +1,226 @@
+# --- 一括採点 ---
+# 先生から預かったクラス全員分の解答画像を、演習モードと同じ役割指示・画像の取り込み処理で採点します。
+# 複数枚を asyncio で並行に送り、API の流量はアプリと同じスケジューラで制御します。
+# 結果は1件終わるごとに CSV または JSON Lines に追記するので、途中で止まっても
+# 同じコマンドを再実行すれば、採点済みの画像を飛ばして続きから採点します。
+# 各行には問題セットのハッシュも残し、問題ファイルを差し替えたときは採点し直します。
+#
+# 使い方:
+#   python batch_grade.py answers/ --problems problems.md --output results.csv --concurrency 8
+
+import argparse
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tutor_backend import BACKENDS, make_backend
+from tutor_images import image_part, ingest_image
+from tutor_prompts import IMAGE_ANSWER_PROMPT, SYSTEM_INSTRUCTIONS
+from tutor_scheduler import DEFAULT_RPM, DEFAULT_TPM, RequestScheduler, estimate_tokens
+
+MODEL_NAME = "gemini-2.5-flash"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+DEFAULT_CONCURRENCY = 4
+DEFAULT_COMMENT = "この画像の解答を採点してください。"
+QUEUE_ID = "batch-grade"
+FIELDS = ["file", "image_hash", "problem_set_hash", "status", "feedback", "error"]
+
+
+def find_images(directory):
+    """ディレクトリ以下の解答画像を、名前順に返す"""
+    return sorted(
+        path for path in Path(directory).rglob("*")
+        if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+
+
+def problem_set_hash(problem_set):
+    return hashlib.sha256(problem_set.encode("utf-8")).hexdigest()
+
+
+def _read_csv(output):
+    """
+    CSV の見出しと、最後まで書き終わった行を読む。3つ目の値は、最後の行が書きかけだったか。
+    回答は複数行になることが多く引用符の中に改行があるので、改行で終わっているかだけでは分からない。
+    """
+    # 書きかけの行は文字の途中で切れていることもあるので、読めないバイトで止まらないようにする
+    with open(output, encoding="utf-8", errors="replace", newline="") as f:
+        text = f.read()
+    # strict にすると、引用符が閉じないままファイルが終わったときに csv.Error になる
+    reader = csv.DictReader(io.StringIO(text, newline=""), strict=True)
+    rows = []
+    try:
+        for row in reader:
+            rows.append(row)
+    except csv.Error:
+        return reader.fieldnames, rows, True
+    # 書きかけの行は改行で終わっていないか、列が足りず足りない列が None になる
+    if not text.endswith("\n") or (rows and None in rows[-1].values()):
+        return reader.fieldnames, rows[:-1], True
+    return reader.fieldnames, rows, False
+
+
+def _read_rows(output):
+    """出力ファイルの行を読む。途中で止まって書きかけになった行は飛ばす"""
+    if output.endswith(".csv"):
+        return _read_csv(output)[1]
+    with open(output, encoding="utf-8", errors="replace", newline="") as f:
+        rows = []
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                continue
+        return rows
+
+
+def drop_partial_row(output):
+    """
+    途中で止まって最後の行が書きかけなら、その行を取り除く。
+    そのまま追記すると次の結果が書きかけの行につながり、CSV では引用符が閉じずに後ろの行まで壊れる。
+    """
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return
+    if output.endswith(".csv"):
+        fieldnames, rows, partial = _read_csv(output)
+        if not partial:
+            return
+        # 読めた行だけで書き直す（見出しも書きかけなら空のファイルにする）
+        tmp_path = output + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            if rows:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+        os.replace(tmp_path, output)
+    else:
+        # JSON Lines の行には改行が入らないので、最後の改行より後ろが書きかけの行
+        with open(output, "rb+") as f:
+            data = f.read()
+            if not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+
+def load_graded(output, problems_hash):
+    """出力ファイルから、同じ問題セットで採点済み（status が ok）の画像の一覧を読む"""
+    if not os.path.exists(output):
+        return set()
+    return {
+        row["file"] for row in _read_rows(output)
+        if isinstance(row, dict) and row.get("status") == "ok" and row.get("problem_set_hash") == problems_hash
+    }
+
+
+def append_result(output, row):
+    """結果を1行追記する（CSV は最初の1行目にヘッダーを書く）"""
+    if output.endswith(".csv"):
+        write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+        with open(output, "a", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            if write_header:
+                writer.writeheader()
+            writer.writerow(row)
+    else:
+        with open(output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def grade_image(model, scheduler, problem_set, path, name):
+    """1枚の解答画像を採点する（スレッドで実行するブロッキング処理）"""
+    with open(path, "rb") as f:
+        image_bytes, image_hash = ingest_image(f)
+    # アプリの演習モードと同じく、出題済みの問題セットに続けて画像の解答を送る
+    history = [
+        {"role": "user", "parts": ["練習問題を出題してください。"]},
+        {"role": "model", "parts": [problem_set]},
+    ]
+    parts = [IMAGE_ANSWER_PROMPT.format(comment=DEFAULT_COMMENT), image_part(image_bytes)]
+
+    def send():
+        chat = model.start_chat(history=history)
+        return "".join(chat.send_message(parts, stream=True))
+
+    feedback = scheduler.call(QUEUE_ID, estimate_tokens([problem_set] + parts), send)
+    return {
+        "file": name,
+        "image_hash": image_hash,
+        "problem_set_hash": problem_set_hash(problem_set),
+        "status": "ok",
+        "feedback": feedback,
+        "error": "",
+    }
+
+
+async def grade_all(model, scheduler, problem_set, images, output, concurrency):
+    """画像を並行に採点し、終わった順に結果を追記する"""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="grade"))
+    semaphore = asyncio.Semaphore(concurrency)
+    finished = 0
+
+    async def grade(path, name):
+        nonlocal finished
+        async with semaphore:
+            try:
+                row = await asyncio.to_thread(grade_image, model, scheduler, problem_set, path, name)
+            except Exception as e:
+                row = {
+                    "file": name,
+                    "image_hash": "",
+                    "problem_set_hash": problem_set_hash(problem_set),
+                    "status": "error",
+                    "feedback": "",
+                    "error": str(e),
+                }
+        append_result(output, row)
+        finished += 1
+        print(f"[{finished}/{len(images)}] {name}: {row['status']}", file=sys.stderr)
+        return row
+
+    return await asyncio.gather(*(grade(path, name) for path, name in images))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="解答画像のフォルダを演習モードと同じ基準で一括採点する")
+    parser.add_argument("images", help="解答画像（jpg/png）のディレクトリ")
+    parser.add_argument("--problems", required=True, help="問題セットを書いたテキスト（Markdown）ファイル")
+    parser.add_argument("--output", default="grades.jsonl", help="結果の出力先（.csv または .jsonl）")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="同時に採点する枚数")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM, help="1分あたりのリクエスト数の上限")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TPM, help="1分あたりのトークン数の上限")
+    parser.add_argument("--backend", choices=BACKENDS, default="gemini")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"), help="省略時は GEMINI_API_KEY")
+    args = parser.parse_args()
+
+    if args.backend == "gemini" and not args.api_key:
+        parser.error("--api-key か環境変数 GEMINI_API_KEY を指定してください。")
+
+    problem_set = Path(args.problems).read_text(encoding="utf-8")
+    drop_partial_row(args.output)
+    graded = load_graded(args.output, problem_set_hash(problem_set))
+    images = [
+        (path, path.relative_to(args.images).as_posix()) for path in find_images(args.images)
+    ]
+    images = [(path, name) for path, name in images if name not in graded]
+    print(f"採点済み {len(graded)} 件、これから採点 {len(images)} 件", file=sys.stderr)
+
+    model = make_backend(
+        args.backend, args.api_key, MODEL_NAME, system_instruction=SYSTEM_INSTRUCTIONS["⚔️ 演習モード"]
+    )
+    scheduler = RequestScheduler(rpm=args.rpm, tpm=args.tpm, max_concurrent=args.concurrency)
+    rows = asyncio.run(grade_all(model, scheduler, problem_set, images, args.output, args.concurrency))
+
+    errors = sum(row["status"] != "ok" for row in rows)
+    if errors:
+        print(f"{errors} 件の採点に失敗しました。もう一度実行すると失敗した画像だけを採点し直します。", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# --- アプリのベンチマーク ---
+# ローカルの FakeBackend（APIキー不要）で Streamlit の AppTest を回し、
+# モード × 入力方法ごとに、50往復のセッションを模擬して次を計測します。
+#   - 1回の再実行（ユーザー操作1回）にかかる時間
+#   - 送信から最初の描画までの時間（time-to-first-render）
+#   - セッションが進むにつれてのメモリ増加
+#     （tracemalloc は処理を遅くするので、時間とは別のセッションで測ります）
+#
+# 使い方:
+#   python benchmarks/bench_app.py --turns 50 --latency 0.05 > bench_output.txt
+
+import argparse
+import io
+import json
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+from PIL import Image, ImageDraw
+from streamlit.testing.v1 import AppTest
+
+import tutor_stream
+from tutor_images import canvas_to_image, ingest_image
+from tutor_prompts import IMAGE_ANSWER_PROMPT
+
+APP_PATH = str(ROOT / "math_tutor.py")
+MODES = ["📖 学習モード", "⚡ 解答確認モード", "⚔️ 演習モード"]
+INPUT_METHODS = ["Text", "Image", "Handwriting"]
+
+# StreamRenderer の最初の描画時刻を記録して time-to-first-render を測る
+first_render_times = []
+_original_render = tutor_stream.StreamRenderer._render
+
+
+def _timed_render(self, final):
+    if not getattr(self, "_bench_rendered", False):
+        self._bench_rendered = True
+        first_render_times.append(time.perf_counter())
+    return _original_render(self, final)
+
+
+tutor_stream.StreamRenderer._render = _timed_render
+
+
+def sample_photo(turn):
+    """スマホ写真の代わりの大きめの画像"""
+    image = Image.new("RGB", (3024, 4032), (235, 235, 230))
+    draw = ImageDraw.Draw(image)
+    for row in range(12):
+        y = 400 + row * 250
+        draw.line((300, y, 2700, y + (turn % 7) * 5), fill=(20, 20, 20), width=12)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    buffer.seek(0)
+    return buffer
+
+
+def sample_canvas(turn):
+    """手書きキャンバスの代わりの RGBA 配列"""
+    rgba = np.zeros((300, 500, 4), dtype=np.uint8)
+    rgba[100:110, 50 + turn % 50:300, 3] = 255
+    rgba[150:220, 200:206, 3] = 255
+    return rgba
+
+
+def submit(at, mode, method, turn):
+    """1回分の送信を行い、再実行を走らせる（画像の取り込み処理も時間に含める）"""
+    started = time.perf_counter()
+    key = at.session_state["form_key_index"]
+    if method == "Text":
+        at.text_area(key=f"user_text_{key}").input(f"問{turn}の答えは 3 です")
+        at.button(key=f"text_submit_{key}").click()
+    else:
+        # AppTest はファイルアップロードとキャンバスを操作できないので、
+        # アプリと同じ取り込み処理を通したメッセージを直接積む
+        if method == "Image":
+            image_bytes, image_hash = ingest_image(sample_photo(turn))
+        else:
+            image_bytes, image_hash = canvas_to_image(sample_canvas(turn))
+        text = "この画像の数学の問題を解いてください。"
+        if mode == "⚔️ 演習モード":
+            text = IMAGE_ANSWER_PROMPT.format(comment=text)
+        at.session_state["messages"].append(
+            {"role": "user", "content": {"image": image_bytes, "image_hash": image_hash, "text": text}}
+        )
+        at.session_state["form_key_index"] = key + 1
+    at.run()
+    return started, time.perf_counter() - started
+
+
+def simulate_session(mode, method, turns, secrets):
+    """新しいセッションで turns 回送信し、毎回の (再実行時間, 最初の描画までの時間) を返す"""
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    for name, value in secrets.items():
+        at.secrets[name] = value
+    at.run()
+    at.sidebar.radio[0].set_value(mode).run()
+
+    timings = []
+    for turn in range(1, turns + 1):
+        before = len(first_render_times)
+        started, elapsed = submit(at, mode, method, turn)
+        if at.exception:
+            raise RuntimeError(f"{mode} / {method}: {at.exception[0].value}")
+        first_render = first_render_times[before] - started if len(first_render_times) > before else None
+        timings.append((elapsed, first_render))
+    return at, timings
+
+
+def run_scenario(mode, method, turns, secrets):
+    at, timings = simulate_session(mode, method, turns, secrets)
+    rerun_times = [elapsed for elapsed, _ in timings]
+    first_render = [ttfr for _, ttfr in timings if ttfr is not None]
+
+    tracemalloc.start()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    simulate_session(mode, method, turns, secrets)
+    memory_end = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return {
+        "mode": mode,
+        "input": method,
+        "turns": turns,
+        "rerun_median_ms": statistics.median(rerun_times) * 1000,
+        "rerun_p95_ms": sorted(rerun_times)[int(len(rerun_times) * 0.95) - 1] * 1000,
+        "rerun_last_ms": rerun_times[-1] * 1000,
+        "first_render_median_ms": statistics.median(first_render) * 1000 if first_render else None,
+        "memory_growth_kb": (memory_end - memory_start) / 1024,
+        "messages": len(at.session_state["messages"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FakeBackend を使ったアプリのベンチマーク")
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="最初のチャンクまでの秒数")
+    parser.add_argument("--chunk-size", type=int, default=24)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--mode", choices=MODES, action="append", help="対象のモード（複数指定可）")
+    parser.add_argument("--input", choices=INPUT_METHODS, action="append", help="対象の入力方法（複数指定可）")
+    parser.add_argument("--json", action="store_true", help="結果を JSON Lines で出力する")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_app_")
+    secrets = {
+        "MODEL_BACKEND": "fake",
+        "FAKE_LATENCY": args.latency,
+        "FAKE_CHUNK_SIZE": args.chunk_size,
+        "FAKE_CHUNK_DELAY": args.chunk_delay,
+        # ベンチマークでは流量制御で待たされないようにする
+        "GEMINI_RPM": 100_000,
+        "GEMINI_TPM": 100_000_000,
+        "GEMINI_MAX_CONCURRENT": 64,
+        # 会話ログ・画像・計測は使い捨てのディレクトリに書く
+        "SESSION_DB": str(Path(work_dir) / "sessions.sqlite3"),
+        "PROBLEM_BANK_DB": str(Path(work_dir) / "problem_bank.sqlite3"),
+        "METRICS_LOG": str(Path(work_dir) / "tutor_metrics.jsonl"),
+    }
+
+    if not args.json:
+        print(f"{'mode':<12} {'input':<12} {'rerun med':>10} {'p95':>8} {'last':>8} {'TTFR med':>9} {'mem +KB':>9}")
+    for mode in args.mode or MODES:
+        for method in args.input or INPUT_METHODS:
+            result = run_scenario(mode, method, args.turns, secrets)
+            if args.json:
+                print(json.dumps(result, ensure_ascii=False))
+                continue
+            ttfr = result["first_render_median_ms"]
+            ttfr_text = "-" if ttfr is None else f"{ttfr:.1f}ms"
+            print(
+                f"{mode:<10} {method:<12} {result['rerun_median_ms']:>8.1f}ms {result['rerun_p95_ms']:>6.1f}ms "
+                f"{result['rerun_last_ms']:>6.1f}ms {ttfr_text:>9} {result['memory_growth_kb']:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,31 @@
+import threading
+import time
+import uuid
+
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
 from streamlit_drawable_canvas import st_canvas
 
-# --- 0. 状態リセット処理（ここが最重要！）---
-# 画面が描画される前に、入力モードのリセット予約があるかチェックします
-if "force_reset_to_text" in st.session_state and st.session_state["force_reset_to_text"]:
-    st.session_state["input_method_radio"] = "Text"  # 強制的にテキストモードに戻す
-    st.session_state["force_reset_to_text"] = False # 予約を解除
+from tutor_answer_check import ANSWER_KEY_PROMPT, format_feedback, grade_answers, parse_answer_key
+from tutor_backend import FAKE_CHUNK_DELAY, FAKE_CHUNK_SIZE, FAKE_LATENCY, make_backend
+from tutor_cache import ResponseCache, make_cache_key
+from tutor_history import SUMMARY_STATE_KEY, build_history, message_text, reset_history
+from tutor_images import canvas_to_image, image_part, ingest_image, make_thumbnail
+from tutor_metrics import RECENT_TURNS, MetricsSink, TurnMetrics, summary_row
+from tutor_prefetch import Prefetcher
+from tutor_problem_bank import DEFAULT_DIFFICULTY, ProblemBank, format_problem_set
+from tutor_prompts import IMAGE_ANSWER_PROMPT, SYSTEM_INSTRUCTIONS
+from tutor_scheduler import (
+    DEFAULT_MAX_CONCURRENT,
+    DEFAULT_RPM,
+    DEFAULT_TPM,
+    RESUME_PROMPT,
+    RequestCancelled,
+    RequestScheduler,
+    estimate_tokens,
+)
+from tutor_session_store import SessionConflict, SessionStore
+from tutor_stream import StreamRenderer
+from tutor_transcribe import transcribe_image
 
 # --- 1. アプリの初期設定 ---
 st.set_page_config(page_title="数学AIチューター", page_icon="📐", layout="wide")
@@ -16,18 +34,85 @@ st.title("📐 高校数学 AIチューター")
 st.caption("Gemini 2.5 Flash 搭載。")
 
 # --- 2. 会話履歴の保存場所 ---
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+@st.cache_resource
+def get_session_store(db_path):
+    # 全セッションの会話ログと画像の保存先（画像はハッシュごとに1回だけ保存）
+    return SessionStore(db_path)
+
+session_db_path = "sessions.sqlite3"
+try:
+    session_db_path = st.secrets.get("SESSION_DB", session_db_path)
+except Exception:
+    pass
+session_store = get_session_store(session_db_path)
+
+def start_session(session_id=None):
+    # セッションID は会話ログのキー兼、流量制御で順番待ちを公平にするための ID。
+    # URL の ?session= に載せておき、再読み込みしても続きから再開できるようにする
+    st.session_state["session_id"] = session_id or uuid.uuid4().hex
+    st.session_state.messages = session_store.load(session_id) if session_id else []
+    st.session_state["logged_count"] = len(st.session_state.messages)
+    st.query_params["session"] = st.session_state["session_id"]
+
+if "session_id" not in st.session_state:
+    start_session(st.query_params.get("session"))
+
+def save_messages():
+    # 画像は本体をストアに移してハッシュだけを残し、応答まで済んだメッセージをログに追記する
+    messages = st.session_state.messages
+    logged_count = st.session_state["logged_count"]
+    for message in messages[logged_count:]:
+        content = message["content"]
+        if isinstance(content, dict) and "image" in content:
+            session_store.put_blob(content["image_hash"], content.pop("image"))
+    answered = len(messages)
+    if messages and messages[-1]["role"] == "user":
+        answered -= 1  # 応答待ちのメッセージは取り消されることがあるので、まだ書かない
+    try:
+        for seq in range(logged_count, answered):
+            session_store.append(st.session_state["session_id"], seq, messages[seq])
+            st.session_state["logged_count"] = seq + 1
+    except SessionConflict:
+        # 別のタブが同じ会話の続きを先に書き込んでいた。どちらの会話も消さないよう、
+        # このタブの会話は新しいセッションとして最初から保存し直す
+        st.session_state["session_id"] = uuid.uuid4().hex
+        st.session_state["logged_count"] = 0
+        st.query_params["session"] = st.session_state["session_id"]
+        st.toast("別のタブで同じ会話が進んでいたため、このタブの会話は新しいセッションとして保存しました。")
+        save_messages()
+
+def save_update(index, key):
+    # 記録済みのメッセージに後から付け足した項目（答えのキー・画像の書き起こし）は、更新として追記する
+    if index < st.session_state["logged_count"]:
+        session_store.update(st.session_state["session_id"], index, {key: st.session_state.messages[index][key]})
+
+# 演習モードの先読み（セッションごとのスレッドプール）
+if "prefetcher" not in st.session_state:
+    st.session_state["prefetcher"] = Prefetcher()
+
+# このセッションで既に出題した問題バンクの問題
+if "seen_problem_ids" not in st.session_state:
+    st.session_state["seen_problem_ids"] = set()
 
 # 各種リセット用キー
-if "uploader_key" not in st.session_state:
-    st.session_state["uploader_key"] = 0
-if "canvas_key" not in st.session_state:
-    st.session_state["canvas_key"] = 0
 if "form_key_index" not in st.session_state:
     st.session_state["form_key_index"] = 0
 
+# 計測（今のターンの計測値と、デバッグ表示用の直近のターン）
+if "recent_turn_metrics" not in st.session_state:
+    st.session_state["recent_turn_metrics"] = []
+
+def current_turn():
+    # 送信してから応答が終わるまでを1ターンとして、その間の計測値をまとめる
+    # （submit() されるまでの再実行や時間は数えない）
+    if "turn_metrics" not in st.session_state:
+        st.session_state["turn_metrics"] = TurnMetrics(st.session_state["session_id"])
+    return st.session_state["turn_metrics"]
+
+current_turn().count("script_runs")
+
 # --- 3. サイドバー（設定＆モード選択） ---
+# ボタンで追加したメッセージは、同じ実行の中で下のチャット欄（フラグメント）が応答します
 with st.sidebar:
     st.header("⚙️ 設定・モード切替")
     
@@ -45,6 +130,9 @@ with st.sidebar:
     
     st.markdown("---")
 
+    # 演習モード以外では先読みしない
+    exam_followups = {}
+
     # ★★★ モード選択 ★★★
     mode = st.radio(
         "学習モードを選択",
@@ -73,8 +161,7 @@ with st.sidebar:
                 直前の内容よりも**難易度を下げて（基礎的な内容にして）**、新しい類題を【{num_questions_learn}問】作成してください。
                 まだ答えや解説は一切書かず、**問題文のみ**を提示してください。
                 """
-                st.session_state.messages.append({"role": "user", "content": prompt_text})
-                st.rerun()
+                st.session_state.messages.append({"role": "user", "content": prompt_text, "kind": "problem_request"})
         
         with l_col2:
             if st.button("➡️ 維持", key="learn_same"):
@@ -83,8 +170,7 @@ with st.sidebar:
                 直前の内容と**同じ難易度**の新しい類題を【{num_questions_learn}問】作成してください。
                 まだ答えや解説は一切書かず、**問題文のみ**を提示してください。
                 """
-                st.session_state.messages.append({"role": "user", "content": prompt_text})
-                st.rerun()
+                st.session_state.messages.append({"role": "user", "content": prompt_text, "kind": "problem_request"})
 
         with l_col3:
             if st.button("↗️ 難しく", key="learn_hard"):
@@ -93,29 +179,24 @@ with st.sidebar:
                 直前の内容よりも**難易度を上げて（応用的な内容にして）**、新しい類題を【{num_questions_learn}問】作成してください。
                 まだ答えや解説は一切書かず、**問題文のみ**を提示してください。
                 """
-                st.session_state.messages.append({"role": "user", "content": prompt_text})
-                st.rerun()
+                st.session_state.messages.append({"role": "user", "content": prompt_text, "kind": "problem_request"})
 
         st.write("👇 **困ったときは...**")
         col_hint, col_ans, col_exp = st.columns(3)
         
         with col_hint:
             if st.button("💡 ヒント"):
-                st.session_state.messages.append({"role": "user", "content": "この問題のヒントをください。まだ答えは教えないでください。"})
-                st.rerun()
+                st.session_state.messages.append({"role": "user", "content": "この問題のヒントをください。まだ答えは教えないでください。", "cacheable": True})
         with col_ans:
             if st.button("解答のみ"):
-                st.session_state.messages.append({"role": "user", "content": "直前の類題の【解答（数値・数式）のみ】を教えてください。解説は不要です。"})
-                st.rerun()
+                st.session_state.messages.append({"role": "user", "content": "直前の類題の【解答（数値・数式）のみ】を教えてください。解説は不要です。", "cacheable": True})
         with col_exp:
             if st.button("解説を見る"):
-                st.session_state.messages.append({"role": "user", "content": "直前の類題の【詳しい解説と解答】を教えてください。"})
-                st.rerun()
+                st.session_state.messages.append({"role": "user", "content": "直前の類題の【詳しい解説と解答】を教えてください。", "cacheable": True})
 
         st.markdown("---")
         if st.button("今日の学びを整理"):
-            st.session_state.messages.append({"role": "user", "content": "ここまでの学習内容の要点をまとめてください。"})
-            st.rerun()
+            st.session_state.messages.append({"role": "user", "content": "ここまでの学習内容の要点をまとめてください。", "cacheable": True})
 
     # --- ■ 2. 解答確認モード ---
     elif mode == "⚡ 解答確認モード":
@@ -142,240 +223,571 @@ with st.sidebar:
         
         selected_subject = st.selectbox("科目を選択", list(math_curriculum.keys()))
         topic_for_prompt = ""
+        bank_query = None
         
         if selected_subject == "手動入力":
             topic_for_prompt = st.text_input("単元名を入力（例：合同式）")
         else:
             selected_topic = st.selectbox("単元を選択", math_curriculum[selected_subject])
             topic_for_prompt = f"{selected_subject}の{selected_topic}"
+            # カリキュラムの単元は問題バンクから出題できる
+            bank_query = {
+                "subject": selected_subject,
+                "topic": selected_topic,
+                "difficulty": DEFAULT_DIFFICULTY,
+                "count": num_q_init,
+            }
 
         if st.button("問題を作成開始"):
             if not topic_for_prompt:
                 st.error("単元を選択してください。")
             else:
                 prompt_text = f"【{topic_for_prompt}】に関する練習問題を【{num_q_init}問】出題してください。問1, 問2...と番号を振ってください。まだ答えは言わないでください。"
-                st.session_state.messages.append({"role": "user", "content": prompt_text})
-                st.rerun()
+                st.session_state.messages.append({"role": "user", "content": prompt_text, "kind": "problem_request", "bank_query": bank_query})
         
         st.markdown("---")
         
         st.write("### ⏩ 次の問題へ")
         num_q_next = st.number_input("次に出す問題数", 1, 5, 1, key="q_next")
         
-        st.caption("難易度を選んで次のセットへ")
-        col_easy, col_same, col_hard = st.columns(3)
-        
-        with col_easy:
-            if st.button("↘️ 易しく", key="exam_easy"):
-                prompt_text = f"""
+        # 次に押されそうなボタンのメッセージ（先読みにも使う）
+        exam_followups = {
+            "exam_easy": {"role": "user", "kind": "problem_request", "content": f"""
                 【教師へのリクエスト】
                 先ほどの問題よりも**難易度を下げて（基礎的な内容にして）**、新しい類題を【{num_q_next}問】作成してください。
                 数値を変え、基本的な理解を確認できるようにしてください。
                 まだ答えは言わないでください。
-                """
-                st.session_state.messages.append({"role": "user", "content": prompt_text})
-                st.rerun()
-
-        with col_same:
-            if st.button("➡️ 維持", key="exam_same"):
-                prompt_text = f"""
+                """},
+            "exam_same": {"role": "user", "kind": "problem_request", "content": f"""
                 【教師へのリクエスト】
                 先ほどの問題と**同じ難易度・同じ解法パターン**の新しい類題を【{num_q_next}問】作成してください。
                 数値を変えて、反復練習できるようにしてください。
                 まだ答えは言わないでください。
-                """
-                st.session_state.messages.append({"role": "user", "content": prompt_text})
-                st.rerun()
-
-        with col_hard:
-            if st.button("↗️ 難しく", key="exam_hard"):
-                prompt_text = f"""
+                """},
+            "exam_hard": {"role": "user", "kind": "problem_request", "content": f"""
                 【教師へのリクエスト】
                 先ほどの問題よりも**難易度を上げて（応用的な内容にして）**、新しい類題を【{num_q_next}問】作成してください。
                 計算を複雑にするか、他の単元との融合問題にするなどして、応用力を試してください。
                 まだ答えは言わないでください。
-                """
-                st.session_state.messages.append({"role": "user", "content": prompt_text})
-                st.rerun()
+                """},
+            "exam_hint": {"role": "user", "content": "分かりません。ヒントをください（答えは言わないで）。", "cacheable": True},
+            "exam_giveup": {"role": "user", "content": "降参です。正解と解説を教えてください。", "cacheable": True},
+        }
+        
+        st.caption("難易度を選んで次のセットへ")
+        col_easy, col_same, col_hard = st.columns(3)
+        
+        with col_easy:
+            if st.button("↘️ 易しく", key="exam_easy"):
+                st.session_state.messages.append(dict(exam_followups["exam_easy"]))
+
+        with col_same:
+            if st.button("➡️ 維持", key="exam_same"):
+                st.session_state.messages.append(dict(exam_followups["exam_same"]))
+
+        with col_hard:
+            if st.button("↗️ 難しく", key="exam_hard"):
+                st.session_state.messages.append(dict(exam_followups["exam_hard"]))
 
         st.markdown("---")
         st.write("👇 **ヘルプ**")
         
         if st.button("💡 ヒントをもらう"):
-             st.session_state.messages.append({"role": "user", "content": "分かりません。ヒントをください（答えは言わないで）。"})
-             st.rerun()
+             st.session_state.messages.append(dict(exam_followups["exam_hint"]))
 
         if st.button("🏳️ ギブアップ（解答を見る）"):
-            st.session_state.messages.append({"role": "user", "content": "降参です。正解と解説を教えてください。"})
-            st.rerun()
+            st.session_state.messages.append(dict(exam_followups["exam_giveup"]))
 
     st.markdown("---")
     
     # 共通：手動リセットボタン
     if st.button("🗑️ 会話をリセット", type="primary"):
-        st.session_state.messages = []
-        st.rerun()
+        start_session()
+        st.session_state["prefetcher"].cancel()
+        st.session_state["seen_problem_ids"] = set()
+        st.session_state["history_pages"] = 1
+        reset_history(st.session_state)
 
-# --- 4. モードごとのプロンプト定義 ---
+# サイドバーのボタンで送信された場合は、ここからターンの時間を測る
+if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
+    current_turn().submit()
 
-base_instruction = """
-あなたは日本の高校数学教師です。数式は必ずLaTeX形式（$マーク）で書いてください。
-画像や手書き入力が送られた場合、それを読み取り、数学的に解釈して応答してください。
-"""
-
-if mode == "📖 学習モード":
-    system_instruction = base_instruction + """
-    【役割：ファシリテーター】
-    - 絶対にすぐに答えを教えないでください（「解答のみ確認」と指示された場合を除く）。
-    - 生徒が自力で気づけるよう、問いかけやヒントで導いてください。
-    """
-elif mode == "⚡ 解答確認モード":
-    system_instruction = base_instruction + """
-    【役割：解答チェッカー】
-    - 結論（答え）を最優先で提示してください。
-    - 画像が送られた場合は、その問題の解答を作成してください。
-    """
-elif mode == "⚔️ 演習モード":
-    system_instruction = base_instruction + """
-    【役割：試験監督・コーチ】
-    - 生徒から数値や数式が送られてきた場合、それを「直前の問題（複数ある場合はそれぞれ）に対する解答」とみなして採点してください。
-    
-    【採点のルール】
-    1. **正解の場合**: 
-       - 「正解です！」と褒めて、詳しい解説を行ってください。
-       - 解説が終わったら、そこで出力を終了してください（勝手に次の問題を出さない）。
-    2. **不正解の場合**: 
-       - 答えは教えず、ヒントを出して再挑戦させてください。
-       - 複数問ある場合は、問ごとに合否を判定してください。
-    3. **ヒント要求の場合**: 
-       - 答えは教えず、考え方のヒントだけを出してください。
-    4. **ギブアップの場合**: 
-       - 正解と解説を提示して終了してください。
-    5. **次の問題（難易度調整）の場合**:
-       - 生徒の指示（易しく/維持/難しく）に従って、難易度を調整した新しい類題を、指定された数だけ出題してください。
-    """
+# --- 4. モードごとのプロンプト定義 ---
+system_instruction = SYSTEM_INSTRUCTIONS[mode]
 
 # --- 5. モデルのセットアップ ---
+@st.cache_resource
+def get_response_cache(db_path):
+    # 全セッションで共有する応答キャッシュ（db_path があればディスクにも保存）
+    return ResponseCache(db_path=db_path)
+
+@st.cache_resource
+def get_problem_bank(db_path):
+    # 全セッションで共有する問題バンク（補充用のスレッドも1つだけ）
+    return ProblemBank(db_path)
+
+@st.cache_resource
+def get_scheduler(api_key, rpm, tpm, max_concurrent):
+    # 同じ API キーを使う全セッションで1つのスケジューラを共有する
+    return RequestScheduler(rpm=rpm, tpm=tpm, max_concurrent=max_concurrent)
+
+@st.cache_resource
+def get_metrics_sink(jsonl_path, prometheus_path):
+    # 全セッションの計測をまとめて書き出す（Prometheus 形式のファイルは任意）
+    return MetricsSink(jsonl_path=jsonl_path, prometheus_path=prometheus_path)
+
+cache_db_path = None
+bank_db_path = "problem_bank.sqlite3"
+rate_limits = {"rpm": DEFAULT_RPM, "tpm": DEFAULT_TPM, "max_concurrent": DEFAULT_MAX_CONCURRENT}
+# "fake" にすると APIキー無しでローカルの決まった応答を使う（負荷試験・ベンチマーク用）
+backend_name = "gemini"
+fake_options = {}
+metrics_log_path = "tutor_metrics.jsonl"
+metrics_prometheus_path = None
+show_metrics_panel = False
+try:
+    cache_db_path = st.secrets.get("RESPONSE_CACHE_DB")
+    bank_db_path = st.secrets.get("PROBLEM_BANK_DB", bank_db_path)
+    rate_limits["rpm"] = int(st.secrets.get("GEMINI_RPM", rate_limits["rpm"]))
+    rate_limits["tpm"] = int(st.secrets.get("GEMINI_TPM", rate_limits["tpm"]))
+    rate_limits["max_concurrent"] = int(st.secrets.get("GEMINI_MAX_CONCURRENT", rate_limits["max_concurrent"]))
+    backend_name = st.secrets.get("MODEL_BACKEND", backend_name)
+    fake_options = {
+        "latency": float(st.secrets.get("FAKE_LATENCY", FAKE_LATENCY)),
+        "chunk_size": int(st.secrets.get("FAKE_CHUNK_SIZE", FAKE_CHUNK_SIZE)),
+        "chunk_delay": float(st.secrets.get("FAKE_CHUNK_DELAY", FAKE_CHUNK_DELAY)),
+    }
+    metrics_log_path = st.secrets.get("METRICS_LOG", metrics_log_path)
+    metrics_prometheus_path = st.secrets.get("METRICS_PROMETHEUS_FILE")
+    show_metrics_panel = bool(st.secrets.get("SHOW_METRICS_PANEL", False))
+except Exception:
+    pass
+if backend_name == "fake" and not api_key:
+    api_key = "fake"
+response_cache = get_response_cache(cache_db_path)
+problem_bank = get_problem_bank(bank_db_path)
+metrics_sink = get_metrics_sink(metrics_log_path, metrics_prometheus_path)
+
+target_model_name = "gemini-2.5-flash"
+
+@st.cache_resource
+def get_models(backend_name, api_key, mode, fake_options):
+    # モデルは (バックエンド, APIキー, モード) ごとに一度だけ作って使い回す
+    model = make_backend(
+        backend_name, api_key, target_model_name,
+        system_instruction=SYSTEM_INSTRUCTIONS[mode], fake_options=fake_options,
+    )
+    # 古い会話の要約用（モードの役割指示は付けない）
+    summary_model = make_backend(backend_name, api_key, target_model_name, fake_options=fake_options)
+    # 問題バンク補充・答えのキー作成用（JSON で出力させる）
+    bank_model = make_backend(
+        backend_name, api_key, target_model_name, json_output=True, fake_options=fake_options
+    )
+    return model, summary_model, bank_model
+
 if api_key:
-    genai.configure(api_key=api_key)
     try:
-        target_model_name = "gemini-2.5-flash"
-        model = genai.GenerativeModel(target_model_name, system_instruction=system_instruction)
-        st.sidebar.caption(f"Active Model: `{target_model_name}`")
+        with current_turn().stage("model_setup"):
+            model, summary_model, bank_model = get_models(backend_name, api_key, mode, fake_options)
+            scheduler = get_scheduler(api_key, **rate_limits)
+        st.sidebar.caption(f"Active Model: `{target_model_name if backend_name == 'gemini' else backend_name}`")
     except Exception as e:
         st.error(f"モデル設定エラー: {e}")
         st.stop()
 
+    session_id = st.session_state["session_id"]
+    # 先読みは本来のリクエストの順番を邪魔しないよう、別の（優先度の低い）待ち行列に並べる
+    background_id = f"{session_id}:background"
+
+    def generate_json(prompt, queue_id):
+        return scheduler.call(
+            queue_id, estimate_tokens([prompt]), lambda: bank_model.generate(prompt),
+            background=queue_id != session_id,
+        )
+
+    def summarize(prompt, queue_id):
+        return scheduler.call(
+            queue_id, estimate_tokens([prompt]), lambda: summary_model.generate(prompt),
+            background=queue_id != session_id,
+        )
+
+    def reply_stream(history, content_to_send):
+        # scheduler.stream に渡す関数（途中で切れたら、受け取った所の続きを頼む）
+        def open_stream(received):
+            if received:
+                chat = model.start_chat(history=history + [
+                    {"role": "user", "parts": content_to_send},
+                    {"role": "model", "parts": [received]},
+                ])
+                response = chat.send_message(RESUME_PROMPT, stream=True)
+            else:
+                chat = model.start_chat(history=history)
+                response = chat.send_message(content_to_send, stream=True)
+            yield from response
+        return open_stream
+
+    def shared_history(messages, state, current_parts):
+        # 先読みする応答はどれも同じ会話の続きなので、履歴（と要約）は最初の1件が作って使い回す
+        lock = threading.Lock()
+        built = []
+
+        def get_history():
+            with lock:
+                if not built:
+                    built.append(build_history(
+                        messages,
+                        current_parts,
+                        state,
+                        count_tokens=model.count_tokens,
+                        generate_text=lambda prompt: summarize(prompt, background_id),
+                    ))
+            return built[0]
+        return get_history
+
+    def prefetch_reply(message, get_history, cancel_event):
+        # 裏のスレッドで実行するので st.* は使わない
+        content_to_send = [message_text(message)]
+        history = get_history()
+        if cancel_event.is_set():
+            return None
+        text = ""
+        tokens = estimate_tokens(content_to_send)
+        try:
+            # 順番待ちの間に取り消されたら、枠を取らずにやめる（古くなった先読みでクォータを使わない）
+            for chunk in scheduler.stream(
+                background_id, tokens, reply_stream(history, content_to_send),
+                background=True, cancelled=cancel_event.is_set,
+            ):
+                if cancel_event.is_set():
+                    return None
+                text += chunk
+        except RequestCancelled:
+            return None
+        return text
+
+    def extract_answer_key(problem_set, cancel_event):
+        # 問題セットから一度だけ機械採点用の答えのキーを作る（裏のスレッドで実行）
+        prompt = ANSWER_KEY_PROMPT.format(problem_set=problem_set)
+        return parse_answer_key(generate_json(prompt, background_id))
+
+    def transcribe(content, queue_id):
+        # 画像の書き起こし（同じ画像は全セッション共通のキャッシュから返す）
+        def generate(parts):
+            return scheduler.call(
+                queue_id, estimate_tokens(parts), lambda: summary_model.generate(parts),
+                background=queue_id != session_id,
+            )
+        image_hash = content["image_hash"]
+        return transcribe_image(image_hash, lambda: session_store.get_blob(image_hash), response_cache, generate)
+
+def finish_turn():
+    # 応答が終わったらターンの計測値を書き出し、次のターンを始める
+    turn = st.session_state.pop("turn_metrics")
+    turn.mode = mode
+    record = metrics_sink.emit(turn)
+    recent = st.session_state["recent_turn_metrics"]
+    recent.append(record)
+    del recent[:-RECENT_TURNS]
+
+# デバッグ用：直近のターンの計測値をサイドバーに表示する（SHOW_METRICS_PANEL で有効化）
+if show_metrics_panel:
+    with st.sidebar.expander("🔧 パフォーマンス計測"):
+        recent = st.session_state["recent_turn_metrics"]
+        if recent:
+            st.dataframe([summary_row(record) for record in reversed(recent)])
+        else:
+            st.caption("まだ記録されたターンがありません。")
+
 # --- 6. チャット表示 ---
-for message in st.session_state.messages:
+HISTORY_PAGE_TURNS = 10  # 一度に表示する往復数（古い会話はボタンで読み込む）
+
+@st.cache_data(max_entries=256)
+def cached_thumbnail(image_hash):
+    # 画像はハッシュをキーにして一度だけ読み込み・縮小・エンコードする
+    return make_thumbnail(session_store.get_blob(image_hash))
+
+if "history_pages" not in st.session_state:
+    st.session_state["history_pages"] = 1
+
+def show_more_history():
+    st.session_state["history_pages"] += 1
+
+def render_message(message):
     with st.chat_message(message["role"]):
         content = message["content"]
         if isinstance(content, dict):
-            if "image" in content:
-                st.image(content["image"], width=300)
+            if "image_hash" in content:
+                st.image(cached_thumbnail(content["image_hash"]))
             if "text" in content:
                 st.markdown(content["text"])
         else:
             st.markdown(content)
 
+def render_history():
+    visible_count = 2 * HISTORY_PAGE_TURNS * st.session_state["history_pages"]
+    hidden_count = max(0, len(st.session_state.messages) - visible_count)
+    if hidden_count:
+        st.button(f"⬆️ 以前の会話を表示（残り{hidden_count}件）", on_click=show_more_history)
+
+    for message in st.session_state.messages[hidden_count:]:
+        render_message(message)
+
 # --- 7. AI応答ロジック ---
-if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
+def respond():
     if not api_key: st.stop()
-    
+
+    turn = current_turn()
     with st.chat_message("assistant"):
         response_placeholder = st.empty()
+        status_placeholder = st.empty()
         full_response = ""
         try:
-            history_for_ai = []
-            for m in st.session_state.messages[:-1]:
-                if m["role"] != "system":
-                    text_content = ""
-                    if isinstance(m["content"], dict):
-                        text_content = m["content"].get("text", "")
-                    else:
-                        text_content = str(m["content"])
-                    history_for_ai.append({"role": m["role"], "parts": [text_content]})
-
-            chat = model.start_chat(history=history_for_ai)
-            
-            current_msg = st.session_state.messages[-1]["content"]
-            content_to_send = []
-            
-            if isinstance(current_msg, dict):
-                if "text" in current_msg: content_to_send.append(current_msg["text"])
-                if "image" in current_msg: content_to_send.append(current_msg["image"])
-            else:
-                content_to_send.append(current_msg)
-
-            response = chat.send_message(content_to_send, stream=True)
-            
-            for chunk in response:
-                if chunk.text:
-                    full_response += chunk.text
+            # 決まった文字列のボタン（ヒント・解答など）は、同じ会話状態なら前回の応答を再生
+            cache_key = None
+            if st.session_state.messages[-1].get("cacheable"):
+                cache_key = make_cache_key(target_model_name, system_instruction, st.session_state.messages)
+                full_response = response_cache.get(cache_key) or ""
+                turn.record_cache("response_cache", bool(full_response))
+
+            prefetcher = st.session_state["prefetcher"]
+            problem_set_index = next(
+                (i for i in range(len(st.session_state.messages) - 1, -1, -1)
+                 if st.session_state.messages[i].get("kind") == "problem_set"),
+                None,
+            )
+            answer_key_job = ("answer_key", problem_set_index)
+
+            # 画像は応答と並行して一度だけ書き起こし、次のターンから履歴で画像の代わりに使う
+            untranscribed = [
+                i for i, m in enumerate(st.session_state.messages)
+                if isinstance(m["content"], dict) and "image_hash" in m["content"] and "transcript" not in m["content"]
+            ]
+            transcript_jobs = [
+                ("transcript", st.session_state.messages[i]["content"]["image_hash"]) for i in untranscribed
+            ]
+            current_content = st.session_state.messages[-1]["content"]
+            if isinstance(current_content, dict) and "image_hash" in current_content:
+                prefetcher.schedule(
+                    ("transcript", current_content["image_hash"]),
+                    lambda cancel_event, content=current_content: transcribe(content, background_id),
+                )
+
+            # 演習モードの答えは、答えのキーがあれば SymPy でその場で採点する
+            if st.session_state.messages[-1].get("kind") == "answer" and problem_set_index is not None:
+                problem_set_msg = st.session_state.messages[problem_set_index]
+                if "answer_key" not in problem_set_msg:
+                    answer_key = prefetcher.take(answer_key_job, wait=False)
+                    if answer_key:
+                        problem_set_msg["answer_key"] = answer_key
+                        save_update(problem_set_index, "answer_key")
+                results = grade_answers(
+                    st.session_state.messages[-1]["answer_text"], problem_set_msg.get("answer_key")
+                )
+                if results:
+                    full_response = format_feedback(results, problem_set_msg["answer_key"])
+                turn.record_cache("local_grading", bool(results))
+
+            # 演習モードで先読み済みなら、それを使う（残りの先読みは会話が進むので破棄）
+            if not full_response:
+                prefetch_key = make_cache_key(target_model_name, system_instruction, st.session_state.messages)
+                full_response = prefetcher.take(prefetch_key) or ""
+                if mode == "⚔️ 演習モード":
+                    turn.record_cache("prefetch", bool(full_response))
+                if cache_key and full_response:
+                    response_cache.put(cache_key, full_response)
+            prefetcher.cancel(keep=[answer_key_job, *transcript_jobs])
+
+            # 演習開始は問題バンクに在庫があればそこから出題し、少なければ裏で補充する
+            bank_query = st.session_state.messages[-1].get("bank_query")
+            answer_key = None
+            if not full_response and bank_query:
+                seen_ids = st.session_state["seen_problem_ids"]
+                problems = problem_bank.take(
+                    bank_query["subject"], bank_query["topic"], bank_query["difficulty"],
+                    bank_query["count"], exclude=seen_ids,
+                )
+                turn.record_cache("problem_bank", bool(problems))
+                if problems:
+                    seen_ids.update(p["id"] for p in problems)
+                    full_response = format_problem_set(problems)
+                    answer_key = [{"answer": p["answer"], "explanation": p["explanation"]} for p in problems]
+                problem_bank.request_refill(
+                    bank_query["subject"], bank_query["topic"], bank_query["difficulty"],
+                    generate=lambda prompt: generate_json(prompt, "problem-bank"),
+                    exclude=seen_ids,
+                )
+
+            if full_response:
+                with turn.stage("render"):
                     response_placeholder.markdown(full_response)
-            
-            st.session_state.messages.append({"role": "model", "content": full_response})
-            st.rerun()
+            else:
+                current_msg = st.session_state.messages[-1]["content"]
+                content_to_send = []
+
+                if isinstance(current_msg, dict):
+                    if "text" in current_msg: content_to_send.append(current_msg["text"])
+                    if "image_hash" in current_msg:
+                        image_bytes = session_store.get_blob(current_msg["image_hash"])
+                        content_to_send.append(image_part(image_bytes))
+                        turn.record_payload("image_bytes", len(image_bytes))
+                else:
+                    content_to_send.append(current_msg)
+
+                def count_tokens(contents):
+                    # 最後に数えた値が、実際に送る履歴＋今回の入力のトークン数になる
+                    tokens = model.count_tokens(contents)
+                    turn.record_payload("history_tokens", tokens)
+                    return tokens
+
+                with turn.stage("transcribe"):
+                    for i in untranscribed:
+                        content = st.session_state.messages[i]["content"]
+                        if content is current_content:
+                            continue
+                        transcript = prefetcher.take(("transcript", content["image_hash"]))
+                        if transcript is None:
+                            try:
+                                transcript = transcribe(content, session_id)
+                            except Exception:
+                                continue  # 書き起こせなければ今回はテキストだけで続け、次のターンで再試行する
+                        content["transcript"] = transcript
+                        save_update(i, "content")
+
+                # 直近の会話＋問題セットはそのまま、古い会話は要約にしてトークン予算内に収める
+                with turn.stage("history"):
+                    history_for_ai = build_history(
+                        st.session_state.messages[:-1],
+                        content_to_send,
+                        st.session_state,
+                        count_tokens=count_tokens,
+                        generate_text=lambda prompt: summarize(prompt, session_id),
+                    )
+
+                # 混雑時は順番待ちの位置を、エラー時は再試行の様子を表示する
+                def show_queue_position(position):
+                    if position > 0:
+                        status_placeholder.caption(f"⏳ 混雑しています。あなたの前に {position} 件のリクエストがあります…")
+
+                def show_retry(attempt, delay):
+                    status_placeholder.caption(f"🔁 混雑のため {delay:.0f} 秒後に再試行します（{attempt}回目）…")
+
+                response = scheduler.stream(
+                    session_id,
+                    estimate_tokens(content_to_send),
+                    reply_stream(history_for_ai, content_to_send),
+                    on_wait=show_queue_position,
+                    on_retry=show_retry,
+                )
+
+                # 一定間隔でまとめて描画し、確定した段落は描き直さない
+                # （最初のチャンクまでの時間には、順番待ちの時間も含まれる）
+                renderer = StreamRenderer(response_placeholder.container())
+                stream_started = time.perf_counter()
+                for chunk in response:
+                    if not renderer.text:
+                        turn.add_time("first_token", time.perf_counter() - stream_started)
+                    status_placeholder.empty()
+                    renderer.feed(chunk)
+                full_response = renderer.finish()
+                turn.add_time("stream", time.perf_counter() - stream_started)
+                turn.add_time("render", renderer.render_seconds)
+
+                if cache_key and full_response:
+                    response_cache.put(cache_key, full_response)
+
+            reply = {"role": "model", "content": full_response}
+            if st.session_state.messages[-1].get("kind") == "problem_request":
+                reply["kind"] = "problem_set"
+                if answer_key:
+                    reply["answer_key"] = answer_key
+            st.session_state.messages.append(reply)
+            turn.record_payload("response_chars", len(full_response))
+            finish_turn()
+
+            # 問題セットが出たら、答えのキーと次に押されそうなボタンの応答を先読みしておく
+            if reply.get("kind") == "problem_set" and mode == "⚔️ 演習モード":
+                if "answer_key" not in reply:
+                    prefetcher.schedule(
+                        ("answer_key", len(st.session_state.messages) - 1),
+                        lambda cancel_event, problem_set=full_response: extract_answer_key(problem_set, cancel_event),
+                    )
+                summary_state = {}
+                if SUMMARY_STATE_KEY in st.session_state:
+                    summary_state[SUMMARY_STATE_KEY] = st.session_state[SUMMARY_STATE_KEY]
+                get_history = shared_history(
+                    list(st.session_state.messages),
+                    summary_state,
+                    [max((message_text(f) for f in exam_followups.values()), key=len)],
+                )
+                for followup in exam_followups.values():
+                    messages = st.session_state.messages + [followup]
+                    prefetcher.schedule(
+                        make_cache_key(target_model_name, system_instruction, messages),
+                        lambda cancel_event, followup=followup: prefetch_reply(followup, get_history, cancel_event),
+                    )
         except Exception as e:
+            turn.count("errors")
             st.error(f"エラー: {e}")
+            # 送信したメッセージが宙に浮かないよう、再試行か取り消しを選べるようにする
+            retry_col, cancel_col = st.columns(2)
+            with retry_col:
+                st.button("🔁 もう一度送る", key="retry_reply")
+            with cancel_col:
+                st.button("↩️ 取り消す", key="cancel_message", on_click=st.session_state.messages.pop)
 
 # --- 8. 入力エリア ---
-if not (st.session_state.messages and st.session_state.messages[-1]["role"] == "user"):
-    
-    # キーを動的に変えて中身をリセットするための変数
+def render_input_area():
+    """入力欄を表示し、送信されたメッセージを返す（送信されなければ None）"""
+    # キーを動的に変えて中身をリセットするための変数（送信のたびに +1 され、入力方法もテキストに戻る）
     current_key = st.session_state["form_key_index"]
-    uploader_key = f"uploader_{current_key}"
-    canvas_key = f"canvas_{current_key}"
 
     st.write("### 📝 入力方法を選択")
-    
+
     input_method = st.radio(
         "入力方法",
         ["Text", "Image", "Handwriting"],
         format_func=lambda x: "⌨️ テキスト" if x == "Text" else ("📸 画像" if x == "Image" else "✍️ 手書き"),
         horizontal=True,
         label_visibility="collapsed",
-        key="input_method_radio"
+        key=f"input_method_{current_key}"
     )
 
     # --- A. テキスト入力モード ---
     if input_method == "Text":
         with st.form(key=f'text_form_{current_key}'):
-            user_text = st.text_area("メッセージを入力", height=70, placeholder="質問や回答を入力してください")
+            user_text = st.text_area("メッセージを入力", height=70, placeholder="質問や回答を入力してください", key=f"user_text_{current_key}")
             col1, col2 = st.columns([1, 6])
             with col1:
-                submit_text = st.form_submit_button("送信", type="primary")
-            
+                submit_text = st.form_submit_button("送信", type="primary", key=f"text_submit_{current_key}")
+
             if submit_text and user_text:
+                current_turn().submit()
                 content = user_text
+                message = {"role": "user", "content": content}
                 if mode == "⚔️ 演習モード":
                     content = f"【生徒の解答】\n{user_text}\n\n※採点してください。正解なら解説のみを行ってください。"
-                st.session_state.messages.append({"role": "user", "content": content})
-                
-                # ★修正：状態リセットを予約する（ここではまだ書き換えない）
-                st.session_state["form_key_index"] += 1
-                st.rerun()
+                    # 答えのキーがあればローカルで採点できるように、生の答えも残す
+                    message = {"role": "user", "content": content, "kind": "answer", "answer_text": user_text}
+                return message
 
     # --- B. 画像アップロードモード ---
     elif input_method == "Image":
         st.info("👇 下のボタンから画像をアップロードしてください")
-        img_file = st.file_uploader("画像を選択", type=["jpg", "png", "jpeg"], key=uploader_key)
+        img_file = st.file_uploader("画像を選択", type=["jpg", "png", "jpeg"], key=f"uploader_{current_key}")
         img_text = st.text_input("補足コメント（任意）", key=f"img_comment_{current_key}")
-        
-        if st.button("画像で送信", type="primary"):
+
+        if st.button("画像で送信", type="primary", key=f"image_send_{current_key}"):
             if img_file:
-                image_data = Image.open(img_file)
+                current_turn().submit()
+                # 向き補正・グレースケール化・縮小してバイト列とハッシュだけを保存
+                with current_turn().stage("image_preprocess"):
+                    image_bytes, image_hash = ingest_image(img_file)
                 text_part = img_text if img_text else "この画像の数学の問題を解いてください。"
                 if mode == "⚔️ 演習モード":
-                    text_part = f"【生徒の画像解答】\n{text_part}\n\n※採点してください。"
-                
-                content_to_save = {"image": image_data, "text": text_part}
-                st.session_state.messages.append({"role": "user", "content": content_to_save})
-                
-                # ★修正：状態リセットを予約して、テキストモードへの強制リセットも予約
-                st.session_state["form_key_index"] += 1
-                st.session_state["force_reset_to_text"] = True
-                st.rerun()
+                    text_part = IMAGE_ANSWER_PROMPT.format(comment=text_part)
+
+                content_to_save = {"image": image_bytes, "image_hash": image_hash, "text": text_part}
+                return {"role": "user", "content": content_to_save}
             else:
                 st.warning("画像を選択してください。")
 
@@ -390,28 +802,74 @@ if not (st.session_state.messages and st.session_state.messages[-1]["role"] == "
             height=300,
             width=500,
             drawing_mode="freedraw",
-            key=canvas_key,
+            key=f"canvas_{current_key}",
             display_toolbar=True
         )
-        
-        if st.button("手書きを送信", type="primary"):
+
+        if st.button("手書きを送信", type="primary", key=f"canvas_send_{current_key}"):
+            # 線の部分だけを切り抜いた2値画像にする（空白なら None）
+            canvas_image = None
+            started = time.perf_counter()
             if canvas_result.image_data is not None:
-                img_data = canvas_result.image_data.astype('uint8')
-                pil_image = Image.fromarray(img_data, "RGBA")
-                background = Image.new("RGB", pil_image.size, (255, 255, 255))
-                background.paste(pil_image, mask=pil_image.split()[3])
-                
+                canvas_image = canvas_to_image(canvas_result.image_data)
+            preprocess_seconds = time.perf_counter() - started
+
+            if canvas_image is None:
+                # 空のまま押されたときはターンを始めない（この後に書く時間や再実行を数えない）
+                st.warning("キャンバスに数式を書いてから送信してください。")
+            else:
+                current_turn().submit()
+                current_turn().add_time("image_preprocess", preprocess_seconds)
+                image_bytes, image_hash = canvas_image
+
                 content_to_save = {
-                    "image": background,
+                    "image": image_bytes,
+                    "image_hash": image_hash,
                     "text": "【生徒の手書き入力】\nこの手書きの数式・図形を読み取って回答してください。"
                 }
                 if mode == "⚔️ 演習モード":
                     content_to_save["text"] = "【生徒の手書き解答】\nこの手書きを解答として採点してください。"
 
-                st.session_state.messages.append({"role": "user", "content": content_to_save})
-                
-                # ★修正：状態リセットを予約して、テキストモードへの強制リセットも予約
-                st.session_state["form_key_index"] += 1
-                st.session_state["force_reset_to_text"] = True
-                st.rerun()
+                return {"role": "user", "content": content_to_save}
+
+    return None
+
+# --- 9. チャット欄（フラグメント） ---
+# 入力・応答はこのフラグメントだけを再実行するので、
+# サイドバーやモデル設定を含むスクリプト全体は走り直しません。
+@st.fragment
+def chat_area():
+    current_turn().count("chat_runs")
+    save_messages()  # サイドバーのボタンで追加されたメッセージ
+
+    def waiting_for_reply():
+        return bool(st.session_state.messages) and st.session_state.messages[-1]["role"] == "user"
+
+    chat_box = st.container()
+    with chat_box:
+        render_history()
+
+    input_slot = st.empty()
+    if not waiting_for_reply():
+        with input_slot.container():
+            new_message = render_input_area()
+        if new_message:
+            st.session_state.messages.append(new_message)
+            st.session_state["form_key_index"] += 1
+            save_messages()
+            with chat_box:
+                render_message(new_message)
+
+    if waiting_for_reply():
+        current_turn().submit()
+        with chat_box:
+            respond()
+        save_messages()
+        # 応答が終わったら、新しいキーの（空の）入力欄に差し替える
+        if not waiting_for_reply():
+            with input_slot.container():
+                render_input_area()
+        else:
+            input_slot.empty()
 
+chat_area()
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from tutor_answer_check import GradingWorkers, grade_answers, parse_answer
+
+
+def key(*answers):
+    return [{"answer": answer, "explanation": ""} for answer in answers]
+
+
+@pytest.mark.parametrize("answer, expected, result", [
+    ("3", "3", [True]),
+    ("4", "3", [False]),
+    ("1.5", "3/2", [True]),
+    ("\\frac{1}{2}", "0.5", [True]),
+    ("2x+1", "1 + 2*x", [True]),
+    ("sqrt(2)/2", "1/sqrt(2)", [True]),
+    ("x = 2, 3", "3, 2", [True]),
+    ("(1, 2)", "(1, 2)", [True]),
+    ("(2, 1)", "(1, 2)", [False]),
+])
+def test_values(answer, expected, result):
+    assert grade_answers(answer, key(expected)) == result
+
+
+def test_named_answers_are_compared_by_name():
+    assert grade_answers("x=2, y=1", key("x = 1, y = 2")) == [False]
+    assert grade_answers("y=2, x=1", key("x = 1, y = 2")) == [True]
+
+
+@pytest.mark.parametrize("answer, expected", [
+    ("x=1, y=2", "(1, 2)"),   # 変数名つきと座標
+    ("2", "2, 3"),            # 解の個数が違う
+    ("(1, 2)", "3"),          # 座標と値
+    ("a=1, b=2", "x = 1, y = 2"),
+])
+def test_different_shapes_defer_to_llm(answer, expected):
+    assert grade_answers(answer, key(expected)) is None
+
+
+@pytest.mark.parametrize("answer", [
+    "9^9^9",
+    "2^(10^6)",
+    "Pow(9, Pow(9, 9))",
+    "Integer(9)**Integer(9)**Integer(9)",
+    "exp(exp(exp(100)))",
+    "sin(10^99 * 10^99)",
+    "x.subs(x, 1)",
+    "().__class__",
+    "1/0",
+    "1" * 500,
+])
+def test_unsafe_input_is_rejected_quickly(answer):
+    started = time.perf_counter()
+    assert parse_answer(answer) is None
+    assert grade_answers(answer, key("3")) is None
+    assert time.perf_counter() - started < 1
+
+
+def test_unknown_names_are_not_called():
+    # 関数名と1文字の変数以外の名前は使えない
+    assert grade_answers("open(x)", key("3")) is None
+
+
+def test_grading_is_time_limited():
+    workers = GradingWorkers(size=1)
+    assert workers.call(pow, (2, 10), timeout=30) == 1024  # 子プロセスの起動を待つ
+
+    # 時間切れの計算は子プロセスごと止まり、次の呼び出しは新しい子プロセスで動く
+    started = time.perf_counter()
+    assert workers.call(time.sleep, (30,), timeout=0.2) is None
+    assert time.perf_counter() - started < 0.5
+    assert workers.call(pow, (2, 10), timeout=30) == 1024
@@ -0,0 +1,26 @@
+from unittest import mock
+
+from tutor_backend import FakeBackend, GeminiBackend, make_backend
+
+
+def test_gemini_models_use_a_client_per_api_key():
+    first = GeminiBackend("key-a", "gemini-2.5-flash")
+    second = GeminiBackend("key-b", "gemini-2.5-flash")
+    same_key = GeminiBackend("key-a", "gemini-2.5-flash", json_output=True)
+    assert first._model._client is same_key._model._client
+    assert first._model._client is not second._model._client
+
+    # 後から別のキーのモデルを作っても、先に作ったモデルは自分のキーで送る
+    client_type = type(first._model._client)
+    with mock.patch.object(client_type, "count_tokens", autospec=True) as count_tokens:
+        count_tokens.return_value = mock.Mock(total_tokens=3)
+        assert first.count_tokens("問題") == 3
+        assert count_tokens.call_args[0][0] is first._model._client
+
+
+def test_fake_backend_streams_the_whole_reply():
+    backend = make_backend("fake", fake_options={"latency": 0, "chunk_size": 5, "chunk_delay": 0})
+    assert isinstance(backend, FakeBackend)
+    chunks = list(backend.start_chat([]).send_message("こんにちは"))
+    assert len(chunks) > 1
+    assert "".join(chunks) == backend._pick(["こんにちは"])
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from batch_grade import append_result, drop_partial_row, load_graded, problem_set_hash
+
+
+def _row(name, problems_hash, status="ok", feedback="よくできました。\n(2) も正解です。"):
+    return {
+        "file": name,
+        "image_hash": "h",
+        "problem_set_hash": problems_hash,
+        "status": status,
+        "feedback": feedback,
+        "error": "",
+    }
+
+
+def test_load_graded_skips_a_half_written_jsonl_line(tmp_path):
+    output = str(tmp_path / "grades.jsonl")
+    problems = problem_set_hash("問題1")
+    append_result(output, _row("a.png", problems))
+    with open(output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(_row("b.png", problems))[:30])
+
+    assert load_graded(output, problems) == {"a.png"}
+
+
+def test_load_graded_resumes_only_the_same_problem_set(tmp_path):
+    for output in (str(tmp_path / "grades.jsonl"), str(tmp_path / "grades.csv")):
+        append_result(output, _row("a.png", problem_set_hash("問題1")))
+        append_result(output, _row("b.png", problem_set_hash("問題2")))
+        append_result(output, _row("c.png", problem_set_hash("問題1"), status="error"))
+
+        assert load_graded(output, problem_set_hash("問題1")) == {"a.png"}
+        assert load_graded(output, problem_set_hash("問題3")) == set()
+
+
+@pytest.mark.parametrize("output_name, cut, graded", [
+    ("grades.jsonl", lambda data: len(data) - 20, {"a.png"}),
+    # 回答の引用符の中、改行の前で止まった
+    ("grades.csv", lambda data: len(data) - 20, {"a.png"}),
+    # 回答の中の改行の直後で止まった（ファイルは改行で終わっている）
+    ("grades.csv", lambda data: data.rfind(b"\n(2)") + 1, {"a.png"}),
+    # 見出しの途中で止まった
+    ("grades.csv", lambda data: data.index(b"\n") - 3, set()),
+])
+def test_drop_partial_row_keeps_later_results_readable(tmp_path, output_name, cut, graded):
+    output = str(tmp_path / output_name)
+    problems = problem_set_hash("問題1")
+    append_result(output, _row("a.png", problems))
+    append_result(output, _row("b.png", problems))
+    with open(output, "rb+") as f:
+        f.truncate(cut(f.read()))
+
+    drop_partial_row(output)
+    append_result(output, _row("c.png", problems))
+    append_result(output, _row("d.png", problems))
+    assert load_graded(output, problems) == graded | {"c.png", "d.png"}
@@ -0,0 +1,57 @@
+import pytest
+
+import tutor_cache
+from tutor_cache import ResponseCache, make_cache_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(tutor_cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    db_path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(db_path, ttl_seconds=60)
+    cache.put("k", "応答")
+    clock[0] += 59
+    assert cache.get("k") == "応答"
+    assert ResponseCache(db_path, ttl_seconds=60).get("k") == "応答"  # 再起動後も SQLite から読める
+
+    clock[0] += 2
+    assert cache.get("k") is None  # プロセス内の LRU からも返さない
+    assert ResponseCache(db_path, ttl_seconds=60).get("k") is None
+
+
+def test_disk_evicts_least_recently_used_entries_first(tmp_path, clock):
+    db_path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(db_path, max_bytes=30)
+    for key in ("a", "b", "c"):
+        cache.put(key, "x" * 10)
+        clock[0] += 1
+    assert ResponseCache(db_path).get("a") == "x" * 10  # a を使ったので、一番古いのは b になる
+    clock[0] += 1
+
+    cache.put("d", "x" * 10)
+    fresh = ResponseCache(db_path)
+    assert fresh.get("b") is None
+    assert [fresh.get(key) for key in ("a", "c", "d")] == ["x" * 10] * 3
+
+
+def test_memory_keeps_at_most_max_entries(clock):
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+
+
+def test_image_hash_changes_the_key():
+    def messages(image_hash):
+        return [{"role": "user", "content": {"text": "解いて", "image_hash": image_hash}}]
+
+    assert make_cache_key("m", "指示", messages("h1")) != make_cache_key("m", "指示", messages("h2"))
+    assert make_cache_key("m", "指示", messages("h1")) == make_cache_key("m", " 指示 ", messages("h1"))
@@ -0,0 +1,29 @@
+from tutor_history import RECENT_TURNS, SUMMARY_BATCH_TURNS, build_history
+
+
+def simulate(turns, tokens_per_message):
+    """turns 往復の会話で、ターンごとの要約の呼び出し回数を返す"""
+    state, messages, calls, per_turn = {}, [], [], []
+    for turn in range(1, turns + 1):
+        messages.append({"role": "user", "content": f"質問{turn}"})
+        before = len(calls)
+        history = build_history(
+            messages[:-1], ["質問"], state,
+            count_tokens=lambda contents: tokens_per_message * len(contents),
+            generate_text=lambda prompt: calls.append(prompt) or "要約",
+        )
+        assert not history or history[0]["role"] == "user"
+        per_turn.append(len(calls) - before)
+        messages.append({"role": "model", "content": f"回答{turn}"})
+    return per_turn
+
+
+def test_summary_is_folded_in_batches():
+    per_turn = simulate(40, tokens_per_message=10)
+    assert max(per_turn) == 1
+    assert sum(per_turn) <= 40 // SUMMARY_BATCH_TURNS
+    assert sum(per_turn[:RECENT_TURNS + SUMMARY_BATCH_TURNS]) == 0
+
+
+def test_over_budget_makes_at_most_one_summary_call_per_turn():
+    assert max(simulate(40, tokens_per_message=2000)) == 1
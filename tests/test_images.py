@@ -0,0 +1,59 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tutor_images import CROP_PADDING, MIN_STROKE_PIXELS, STROKE_ALPHA_THRESHOLD, canvas_to_image
+
+
+def canvas(height=300, width=500):
+    """手書きキャンバスの RGBA 配列（透明な背景）"""
+    return np.zeros((height, width, 4), dtype=np.uint8)
+
+
+def decode(result):
+    data, _ = result
+    with Image.open(io.BytesIO(data)) as image:
+        return np.asarray(image.convert("1"))
+
+
+def test_blank_canvas_is_not_sent():
+    assert canvas_to_image(canvas()) is None
+
+
+def test_a_few_stray_pixels_count_as_blank():
+    rgba = canvas()
+    rgba[10, :MIN_STROKE_PIXELS - 1, 3] = 255
+    rgba[20:40, 20:40, 3] = STROKE_ALPHA_THRESHOLD - 1  # 薄すぎる線
+    assert canvas_to_image(rgba) is None
+
+    rgba[10, MIN_STROKE_PIXELS - 1, 3] = 255
+    assert canvas_to_image(rgba) is not None
+
+
+def test_crop_keeps_padding_around_the_strokes():
+    rgba = canvas()
+    rgba[100:110, 50:300, 3] = 255
+    image = decode(canvas_to_image(rgba))
+    assert image.shape == (10 + 2 * CROP_PADDING, 250 + 2 * CROP_PADDING)
+    # 線は黒（False）、余白は白（True）
+    assert not image[CROP_PADDING:-CROP_PADDING, CROP_PADDING:-CROP_PADDING].any()
+    assert image[:CROP_PADDING].all() and image[:, -CROP_PADDING:].all()
+
+
+@pytest.mark.parametrize("rows, cols", [
+    (slice(0, 5), slice(0, 40)),        # 左上の角
+    (slice(295, 300), slice(460, 500)),  # 右下の角
+])
+def test_crop_is_clamped_at_the_canvas_edges(rows, cols):
+    rgba = canvas()
+    rgba[rows, cols, 3] = 255
+    image = decode(canvas_to_image(rgba))
+    assert image.shape == (5 + CROP_PADDING, 40 + CROP_PADDING)
+
+
+def test_same_drawing_gives_the_same_hash():
+    rgba = canvas()
+    rgba[150:220, 200:206, 3] = 255
+    assert canvas_to_image(rgba) == canvas_to_image(rgba.copy())
@@ -0,0 +1,27 @@
+import json
+
+from tutor_metrics import MetricsSink, TurnMetrics
+
+
+def test_nothing_is_recorded_before_submit():
+    turn = TurnMetrics("s")
+    turn.count("chat_runs")          # 手書きの1画ごとの再実行など
+    turn.add_time("model_setup", 5.0)
+    turn.submit()
+    turn.count("chat_runs")
+    turn.add_time("stream", 0.2)
+    record = turn.to_record()
+    assert record["counts"] == {"chat_runs": 1}
+    assert record["stages_ms"] == {"stream": 200.0}
+    assert record["duration_ms"] < 1000
+
+
+def test_sink_writes_jsonl_and_prometheus(tmp_path):
+    sink = MetricsSink(jsonl_path=str(tmp_path / "m.jsonl"), prometheus_path=str(tmp_path / "m.prom"))
+    turn = TurnMetrics("s", mode="学習")
+    turn.submit()
+    turn.record_cache("prefetch", True)
+    sink.emit(turn)
+    assert json.loads((tmp_path / "m.jsonl").read_text(encoding="utf-8"))["cache"] == {"prefetch": "hit"}
+    prom = (tmp_path / "m.prom").read_text(encoding="utf-8")
+    assert 'tutor_cache_events_total{cache="prefetch",outcome="hit"} 1' in prom
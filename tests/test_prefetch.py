@@ -0,0 +1,37 @@
+import threading
+import time
+
+from tutor_prefetch import Prefetcher
+
+
+def test_take_waits_for_a_running_job():
+    prefetcher = Prefetcher(max_workers=1)
+    started = threading.Event()
+    prefetcher.schedule("a", lambda cancel_event: started.set() or time.sleep(0.1) or "A")
+    started.wait(1)
+    assert prefetcher.take("a") == "A"
+
+
+def test_take_cancels_a_job_that_has_not_started():
+    prefetcher = Prefetcher(max_workers=1)
+    release = threading.Event()
+    ran = []
+    prefetcher.schedule("busy", lambda cancel_event: release.wait(1))
+    prefetcher.schedule("queued", lambda cancel_event: ran.append(True) or "Q")
+
+    started = time.perf_counter()
+    assert prefetcher.take("queued") is None  # 呼び出し側で直接作る
+    assert time.perf_counter() - started < 0.5
+    release.set()
+    assert prefetcher.take("busy") is True
+    time.sleep(0.05)
+    assert not ran
+
+
+def test_take_without_wait_leaves_unfinished_jobs():
+    prefetcher = Prefetcher(max_workers=1)
+    release = threading.Event()
+    prefetcher.schedule("a", lambda cancel_event: release.wait(1) and "A")
+    assert prefetcher.take("a", wait=False) is None
+    release.set()
+    assert prefetcher.take("a") == "A"
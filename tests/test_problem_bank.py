@@ -0,0 +1,14 @@
+from tutor_problem_bank import ProblemBank
+
+
+def test_count_and_take_skip_excluded_problems(tmp_path):
+    bank = ProblemBank(str(tmp_path / "bank.sqlite3"))
+    bank.add("数学I", "二次関数", "標準", [(f"問題{i}", str(i), "") for i in range(5)])
+    bank.add("数学I", "三角比", "標準", [("別の単元", "1", "")])
+    seen = [p["id"] for p in bank.take("数学I", "二次関数", "標準", 2)]
+
+    assert bank.count("数学I", "二次関数", "標準") == 5
+    assert bank.count("数学I", "二次関数", "標準", exclude=seen) == 3
+    rest = bank.take("数学I", "二次関数", "標準", 3, exclude=seen)
+    assert {p["id"] for p in rest}.isdisjoint(seen)
+    assert bank.take("数学I", "二次関数", "標準", 4, exclude=seen) is None
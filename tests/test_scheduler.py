@@ -0,0 +1,82 @@
+import threading
+import time
+
+from tutor_scheduler import RequestCancelled, RequestScheduler
+
+
+def test_interactive_requests_go_before_background_ones():
+    scheduler = RequestScheduler(rpm=1000, tpm=10_000_000, max_concurrent=1)
+    order = []
+    scheduler.acquire("busy", 1)  # 枠を埋めておき、その間に両方を並ばせる
+
+    def run(session_id, background):
+        with scheduler.slot(session_id, 1, background=background):
+            order.append(session_id)
+
+    threads = [threading.Thread(target=run, args=("student:background", True))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=run, args=("student", False)))
+    threads[1].start()
+    time.sleep(0.05)
+    scheduler.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["student", "student:background"]
+
+
+def test_background_leaves_a_concurrency_slot_free():
+    scheduler = RequestScheduler(rpm=1000, tpm=10_000_000, max_concurrent=2)
+    scheduler.acquire("a:background", 1, background=True)
+    acquired = threading.Event()
+    thread = threading.Thread(
+        target=lambda: scheduler.acquire("b:background", 1, background=True) or acquired.set(), daemon=True
+    )
+    thread.start()
+    assert not acquired.wait(0.3)
+    scheduler.acquire("student", 1)  # 生徒のリクエストは残しておいた枠ですぐ始まる
+
+
+def test_on_wait_is_called_without_holding_the_lock():
+    scheduler = RequestScheduler(rpm=1000, tpm=10_000_000, max_concurrent=1)
+    scheduler.acquire("busy", 1)
+    lock_free = []
+
+    def on_wait(position):
+        got = scheduler._cond.acquire(blocking=False)
+        lock_free.append(got)
+        if got:
+            scheduler._cond.release()
+
+    thread = threading.Thread(target=lambda: scheduler.acquire("student", 1, on_wait=on_wait))
+    thread.start()
+    time.sleep(0.1)
+    scheduler.release()
+    thread.join(5)
+    assert lock_free and all(lock_free)
+
+
+def test_request_cancelled_while_waiting_is_never_sent():
+    scheduler = RequestScheduler(rpm=1000, tpm=10_000_000, max_concurrent=1)
+    scheduler.acquire("busy", 1)
+    cancel_event = threading.Event()
+    sent = []
+    result = []
+
+    def prefetch():
+        try:
+            result.extend(scheduler.stream(
+                "student:background", 1, lambda received: sent.append(True) or iter(["reply"]),
+                background=True, cancelled=cancel_event.is_set,
+            ))
+        except RequestCancelled:
+            result.append("cancelled")
+
+    thread = threading.Thread(target=prefetch)
+    thread.start()
+    time.sleep(0.1)
+    cancel_event.set()
+    thread.join(5)
+    scheduler.release()
+    assert result == ["cancelled"] and not sent
+    assert not scheduler._background  # 順番待ちの列からも外れている
@@ -0,0 +1,32 @@
+import pytest
+
+from tutor_session_store import SessionConflict, SessionStore
+
+
+def test_append_refuses_a_seq_written_by_another_tab(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.sqlite3"))
+    store.append("s", 0, {"role": "user", "content": "first tab"})
+    with pytest.raises(SessionConflict):
+        store.append("s", 0, {"role": "user", "content": "second tab"})
+    assert store.load("s") == [{"role": "user", "content": "first tab"}]
+
+
+def test_load_applies_updates_in_order(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.sqlite3"))
+    store.append("s", 0, {"role": "assistant", "content": "問題", "kind": "problem_set"})
+    store.append("s", 1, {"role": "user", "content": {"text": "", "image_hash": "h"}})
+    store.update("s", 0, {"answer_key": [["x", "1"]]})
+    store.update("s", 1, {"content": {"text": "", "image_hash": "h", "transcript": "古い"}})
+    store.update("s", 1, {"content": {"text": "", "image_hash": "h", "transcript": "$x=1$"}})
+
+    messages = store.load("s")
+    assert messages[0]["answer_key"] == [["x", "1"]]
+    assert messages[1]["content"]["transcript"] == "$x=1$"
+
+
+def test_blobs_are_stored_once_per_hash(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.sqlite3"))
+    store.put_blob("h", b"first")
+    store.put_blob("h", b"second")
+    assert store.get_blob("h") == b"first"
+    assert store.get_blob("missing") is None
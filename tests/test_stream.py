@@ -0,0 +1,60 @@
+import pytest
+
+from tutor_stream import StreamRenderer, _safe_tail, _split_committed
+
+
+@pytest.mark.parametrize("text, committed", [
+    ("段落1\n\n段落2", "段落1\n\n"),
+    ("段落1\n\n段落2\n\n書きかけ", "段落1\n\n段落2\n\n"),
+    ("まだ1段落目", ""),
+    # $$...$$ の中の空行では切らない
+    ("前\n\n$$\na\n\nb", "前\n\n"),
+    ("$$\na\n\nb\n$$\n\n後", "$$\na\n\nb\n$$\n\n"),
+    # コードブロックの中の空行でも切らない
+    ("```\nx = 1\n\ny = 2", ""),
+    ("```\nx = 1\n\ny = 2\n```\n\n後", "```\nx = 1\n\ny = 2\n```\n\n"),
+])
+def test_split_committed(text, committed):
+    head, tail = _split_committed(text)
+    assert head == committed
+    assert head + tail == text
+
+
+@pytest.mark.parametrize("text, shown", [
+    ("答えは $x = 1$ です", "答えは $x = 1$ です"),
+    ("答えは $x = ", "答えは "),
+    ("式 $$\\frac{1}{2", "式 "),
+    ("$$a$$ と $b", "$$a$$ と "),
+    ("値段は \\$5 です", "値段は \\$5 です"),
+])
+def test_safe_tail_holds_back_unclosed_math(text, shown):
+    assert _safe_tail(text) == shown
+
+
+class FakeSlot:
+    text = None
+
+    def markdown(self, text):
+        self.text = text
+
+
+class FakeContainer:
+    def __init__(self):
+        self.slots = []
+
+    def empty(self):
+        self.slots.append(FakeSlot())
+        return self.slots[-1]
+
+
+def test_renderer_freezes_paragraphs_and_shows_everything_at_the_end():
+    container = FakeContainer()
+    renderer = StreamRenderer(container, interval=0)
+    for chunk in ["段落1\n", "\n$$\na\n", "\nb\n$$\n\n段落", "3 $x", "$"]:
+        renderer.feed(chunk)
+    text = renderer.finish()
+
+    assert text == "段落1\n\n$$\na\n\nb\n$$\n\n段落3 $x$"
+    assert "".join(slot.text or "" for slot in container.slots) == text
+    assert container.slots[0].text == "段落1\n\n"
+    assert container.slots[1].text == "$$\na\n\nb\n$$\n\n"  # 数式ブロックは途中で分かれない
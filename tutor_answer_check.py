@@ -0,0 +1,372 @@
+# --- 答えのローカル採点 ---
+# 高校数学の答えの多くは数値か簡単な式なので、答えのキーがあれば
+# SymPy で同値判定するだけで正誤が分かります（LLM を呼ばずに 100ms 未満）。
+# 解釈できない答えは None を返し、今まで通り LLM に採点を任せます。
+# 生徒の入力を parse_expr（内部で eval）に通すので、使える名前を絞り、長さ・指数・途中の値に上限を設け、
+# さらに子プロセスで実行して、時間切れなら子プロセスごと止めます（スレッドは途中で止められないため）。
+
+import json
+import multiprocessing
+import random
+import re
+import threading
+import unicodedata
+
+import sympy
+from sympy.parsing.sympy_parser import (
+    convert_xor,
+    implicit_multiplication_application,
+    parse_expr,
+    standard_transformations,
+)
+
+TRANSFORMATIONS = standard_transformations + (implicit_multiplication_application, convert_xor)
+LOCAL_NAMES = {"e": sympy.E, "i": sympy.I, "pi": sympy.pi}
+# parse_expr が参照できる名前（組み込み関数は空にする）。Integer などは parse_expr が生成するコードが使うもので、
+# 生徒の入力からは呼べないように、parse_answer で関数名と1文字の変数以外の名前を先に弾く
+GLOBAL_NAMES = {
+    "__builtins__": {},
+    "Integer": sympy.Integer, "Float": sympy.Float, "Rational": sympy.Rational, "Symbol": sympy.Symbol,
+    "Add": sympy.Add, "Mul": sympy.Mul, "Pow": sympy.Pow,
+    "sqrt": sympy.sqrt, "sin": sympy.sin, "cos": sympy.cos, "tan": sympy.tan,
+    "log": sympy.log, "ln": sympy.log, "exp": sympy.exp,
+}
+NUMERIC_SAMPLES = 5
+SAMPLE_RANGE = (0.5, 2.5)
+TOLERANCE = 1e-9
+MAX_ANSWER_LENGTH = 200  # これより長い答えは LLM に任せる
+MAX_EXPONENT = 100       # 9^9^9 のような巨大な累乗は計算せずに LLM に任せる
+MAX_MAGNITUDE = 1e100    # 途中の値（exp や sin の引数など）がこれより大きい式も LLM に任せる
+GRADE_TIMEOUT = 2.0      # 秒。超えたら LLM に任せる
+GRADE_WORKERS = 2        # 同時に採点する子プロセスの数
+WORKER_START_TIMEOUT = 30.0  # 子プロセスの起動（SymPy の読み込み）を待つ秒数。採点の時間制限とは別に数える
+
+ANSWER_KEY_PROMPT = """
+次の問題セットについて、各問の最終的な答えと解説を作成してください。
+答えは SymPy で解釈できる形式（例: 3/2, sqrt(2), 2*x + 1, (1, 2)）で、数値または数式のみにしてください。
+答えが1つの値や式で表せない問題（証明・説明など）は answer を空文字にしてください。
+次の形式の JSON 配列だけを、問の順番に出力してください。
+[{{"answer": "答え", "explanation": "詳しい解説（LaTeX形式）"}}]
+
+【問題セット】
+{problem_set}
+"""
+
+_FUNCTIONS = ("sqrt", "sin", "cos", "tan", "log", "ln", "exp", "pi")
+
+
+def _latex_to_text(text):
+    """LaTeX や全角文字まじりの答えを SymPy で読める文字列にする"""
+    text = unicodedata.normalize("NFKC", text).replace("$", "").strip()
+    text = re.sub(r"\\left|\\right|\\,|\\;|\\!", "", text)
+    text = text.replace("\\dfrac", "\\frac").replace("\\tfrac", "\\frac")
+    previous = None
+    while previous != text:
+        previous = text
+        text = re.sub(r"\\frac\{([^{}]*)\}\{([^{}]*)\}", r"((\1)/(\2))", text)
+        text = re.sub(r"\\sqrt\[([^\]]*)\]\{([^{}]*)\}", r"((\2)**(1/(\1)))", text)
+        text = re.sub(r"\\sqrt\{([^{}]*)\}", r"sqrt(\1)", text)
+    text = re.sub(r"√\(", "sqrt(", text)
+    text = re.sub(r"√([0-9A-Za-z]+)", r"sqrt(\1)", text)
+    text = text.replace("π", "pi").replace("\\cdot", "*").replace("\\times", "*").replace("\\div", "/")
+    for name in _FUNCTIONS:
+        text = text.replace("\\" + name, name)
+    return text.replace("{", "(").replace("}", ")").replace("\\", "")
+
+
+def _split_top_level(text, separator=","):
+    """括弧の外にある区切り文字で分割する（座標 (1, 2) は分割しない）"""
+    parts, depth, current = [], 0, ""
+    for char in text:
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        if char == separator and depth == 0:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    parts.append(current)
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _names_allowed(text):
+    """式に出てくる名前が、sqrt などの関数名か1文字の変数だけか（Pow(...) や Integer(...) は呼ばせない）"""
+    names = re.findall(r"[A-Za-z]+", re.sub(r"\d*\.?\d+", " ", text))
+    return all(len(name) == 1 or name in _FUNCTIONS for name in names)
+
+
+def _within_bounds(value):
+    """
+    累乗の指数と、式の途中の値（exp・sqrt・三角関数の引数を含む）がどれも上限以内か。
+    内側から順に調べるので、9^9^9 や exp(exp(exp(100))) は大きな値を計算する前に止まる。
+    """
+    point = {s: SAMPLE_RANGE[1] for s in value.free_symbols}
+    for node in sympy.postorder_traversal(value):
+        if not isinstance(node, sympy.Expr):
+            continue
+        try:
+            if isinstance(node, sympy.Pow) and abs(complex(node.exp.evalf(subs=point))) > MAX_EXPONENT:
+                return False
+            if not abs(complex(node.evalf(subs=point))) <= MAX_MAGNITUDE:
+                return False  # 1/0 のような値（nan）もここで弾く
+        except (TypeError, ValueError, OverflowError):
+            return False
+    return True
+
+
+def parse_answer(text):
+    """
+    答えの文字列を (変数名, SymPy の式) のリストにする（解釈できなければ None）。
+    「x = 3」は ("x", 3)、名前の無い答えは (None, 3) になる。
+    """
+    text = re.sub(r"または|、", ",", text)
+    text = _latex_to_text(text)
+    if not text or len(text) > MAX_ANSWER_LENGTH or re.search(r"[^\x00-\x7f]|_", text):
+        # 日本語の説明や添字（\log_2 など）が混ざった答えは LLM に任せる
+        return None
+    if "." in re.sub(r"\d*\.\d+", "", text):
+        # 小数点以外の「.」（x.subs(...) のような属性の参照）は受け付けない
+        return None
+    values = []
+    for part in _split_top_level(text):
+        name = None
+        if "=" in part:
+            name, _, part = part.partition("=")
+            name = name.strip()
+            if "=" in part or not re.fullmatch(r"[A-Za-z][A-Za-z0-9]*", name):
+                return None
+        if not _names_allowed(part):
+            return None
+        try:
+            value = parse_expr(
+                part.strip(), local_dict=dict(LOCAL_NAMES), global_dict=dict(GLOBAL_NAMES),
+                transformations=TRANSFORMATIONS, evaluate=False,
+            )
+        except Exception:
+            return None
+        if isinstance(value, tuple):
+            value = sympy.Tuple(*value)
+        if not isinstance(value, (sympy.Expr, sympy.Tuple)) or not _within_bounds(value):
+            return None
+        values.append((name, value))
+    return values or None
+
+
+def _same_shape(a, b):
+    """座標と値のように形の違う答えどうしか（形が違えば比べずに LLM に任せる）"""
+    if isinstance(a, sympy.Tuple) or isinstance(b, sympy.Tuple):
+        return (isinstance(a, sympy.Tuple) and isinstance(b, sympy.Tuple) and len(a) == len(b)
+                and all(_same_shape(x, y) for x, y in zip(a, b)))
+    return True
+
+
+def _equal(a, b):
+    if isinstance(a, sympy.Tuple):
+        return all(_equal(x, y) for x, y in zip(a, b))
+
+    diff = a - b
+    symbols = sorted(a.free_symbols | b.free_symbols, key=str)
+    # 記号を含む式は、いくつかの乱数点で値を比べる
+    for _ in range(NUMERIC_SAMPLES if symbols else 1):
+        point = {s: sympy.Float(random.uniform(*SAMPLE_RANGE)) for s in symbols}
+        try:
+            value = complex(diff.evalf(subs=point))
+            scale = 1 + abs(complex(a.evalf(subs=point)))
+        except (TypeError, ValueError):
+            return False
+        if not abs(value) <= TOLERANCE * scale:
+            return False
+    return True
+
+
+def parse_answer_key(text):
+    """ANSWER_KEY_PROMPT に対するモデルの JSON 出力を答えのキーにする"""
+    items = json.loads(text)
+    return [
+        {"answer": str(item.get("answer", "")), "explanation": item.get("explanation", "")}
+        for item in items
+    ]
+
+
+def _free_symbols(values):
+    symbols = set()
+    for _, value in values:
+        symbols |= value.free_symbols
+    return symbols
+
+
+def _by_name(values):
+    """
+    答えを変数名ごとにまとめる。
+    「x = 2, 3」「x = 2, x = 3」のように1つの変数の解の組なら名前は None にそろえる。
+    """
+    names = {name for name, _ in values if name is not None}
+    if len(names) <= 1:
+        return {None: [value for _, value in values]}
+    if any(name is None for name, _ in values):
+        return None  # 「x = 1, 2, y = 3」のように名前の有無が混ざっていると対応が分からない
+    grouped = {}
+    for name, value in values:
+        grouped.setdefault(name, []).append(value)
+    return grouped
+
+
+def _values_match(student, expected):
+    """1つの変数の解の組（順不同）が一致するか。形が違えば None"""
+    if len(student) != len(expected) or not _same_shape(student[0], expected[0]):
+        return None
+    if not all(_same_shape(value, expected[0]) for value in student + expected):
+        return None
+    remaining = list(expected)
+    for value in student:
+        for i, candidate in enumerate(remaining):
+            if _equal(value, candidate):
+                del remaining[i]
+                break
+        else:
+            return False
+    return True
+
+
+def answers_match(student, expected):
+    """
+    答えが一致するか。「x = 1, y = 2」のような答えは変数名ごとに比べる。
+    答えの形（変数名・個数・座標の次元）が違うときは判定せず None を返す。
+    """
+    student, expected = _by_name(student), _by_name(expected)
+    if student is None or expected is None or student.keys() != expected.keys():
+        return None
+    results = [_values_match(student[name], expected[name]) for name in expected]
+    if None in results:
+        return None
+    return all(results)
+
+
+def split_student_answers(text, count):
+    """生徒の入力を問ごとに分ける（1問なら全体、複数問なら1行1問）"""
+    if count == 1:
+        return [text]
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    lines = [re.sub(r"^(問\s*\d+|\(\d+\)|\d+[.)])\s*[:：.)]?\s*", "", line) for line in lines]
+    if len(lines) != count:
+        return None
+    return lines
+
+
+def _worker_main(conn):
+    """採点用の子プロセス。(関数, 引数) を受け取って結果を送り返す"""
+    conn.send("ready")
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = func(*args)
+        except Exception:
+            result = None
+        conn.send(result)
+
+
+class GradingWorkers:
+    """
+    採点を時間制限つきで実行する子プロセスの集まり。
+    時間切れになった子プロセスは kill して捨て、次の呼び出しで新しく起動する。
+    """
+
+    def __init__(self, size=GRADE_WORKERS):
+        # Streamlit はスレッドを多く使うので、fork ではなく spawn で起動する
+        self._context = multiprocessing.get_context("spawn")
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _start(self):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        if not conn.poll(WORKER_START_TIMEOUT) or conn.recv() != "ready":
+            process.kill()
+            raise RuntimeError("採点用のプロセスを起動できませんでした")
+        return process, conn
+
+    def call(self, func, args, timeout):
+        """子プロセスで func(*args) を実行する。timeout 秒を超えるか失敗したら None"""
+        if not self._slots.acquire(timeout=timeout):
+            return None
+        try:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            try:
+                process, conn = worker or self._start()
+            except (OSError, RuntimeError):
+                return None
+            try:
+                conn.send((func, args))
+                if conn.poll(timeout):
+                    result = conn.recv()
+                    with self._lock:
+                        self._idle.append((process, conn))
+                    return result
+            except (EOFError, OSError):
+                pass
+            # 時間切れ（または子プロセスが落ちた）。計算中の子プロセスは止める
+            process.kill()
+            conn.close()
+            return None
+        finally:
+            self._slots.release()
+
+
+_workers = GradingWorkers()
+
+
+def grade_answers(answer_text, answer_key, timeout=GRADE_TIMEOUT):
+    """
+    answer_key（[{"answer": ..., "explanation": ...}, ...]）で生徒の答えを採点する。
+    問ごとの正誤のリストを返す。1問でも解釈できないか、timeout 秒を超えたら None（LLM に任せる）。
+    """
+    return _workers.call(_grade_answers, (answer_text, answer_key), timeout)
+
+
+def _grade_answers(answer_text, answer_key):
+    if not answer_key or not all(item.get("answer") for item in answer_key):
+        return None
+    answers = split_student_answers(answer_text, len(answer_key))
+    if answers is None:
+        return None
+
+    results = []
+    for answer, item in zip(answers, answer_key):
+        student = parse_answer(answer)
+        expected = parse_answer(item["answer"])
+        if student is None or expected is None:
+            return None
+        # 答えのキーに無い文字が出てきたら読み違いの可能性があるので LLM に任せる
+        if _free_symbols(student) - _free_symbols(expected):
+            return None
+        correct = answers_match(student, expected)
+        if correct is None:
+            return None
+        results.append(correct)
+    return results
+
+
+def format_feedback(results, answer_key):
+    """ローカル採点の結果を、演習モードの採点ルールに沿った文面にする"""
+    blocks = []
+    for number, (correct, item) in enumerate(zip(results, answer_key), 1):
+        label = f"問{number}" if len(results) > 1 else "この問題"
+        if correct:
+            block = f"✅ **{label}：正解です！**"
+            if item.get("explanation"):
+                block += f"\n\n**解説**\n\n{item['explanation']}"
+        else:
+            block = f"❌ **{label}：不正解です。** もう一度考えてみましょう。"
+        blocks.append(block)
+    if not all(results):
+        blocks.append("分からないときは「💡 ヒントをもらう」を押してください。")
+    return "\n\n---\n\n".join(blocks)
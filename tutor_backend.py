@@ -0,0 +1,135 @@
+# --- モデルのバックエンド ---
+# アプリが使うのは start_chat / send_message（ストリーミング）/ count_tokens / generate だけなので、
+# それを小さなインターフェースにまとめて差し替えられるようにします。
+# - GeminiBackend: 本番用（google.generativeai）
+# - FakeBackend:   APIキー無しで動く決まった応答のローカル実装（負荷試験・ベンチマーク用）
+
+import functools
+import hashlib
+import json
+import re
+import time
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+BACKENDS = ("gemini", "fake")
+
+FAKE_LATENCY = 0.3      # 最初のチャンクまでの秒数
+FAKE_CHUNK_SIZE = 24    # 1チャンクの文字数
+FAKE_CHUNK_DELAY = 0.02 # チャンク間の秒数
+
+FAKE_RESPONSES = [
+    "いい質問ですね。まず与えられた式を整理しましょう。\n\n"
+    "$x^2 - 5x + 6 = 0$ は $(x-2)(x-3) = 0$ と因数分解できます。\n\n"
+    "したがって $x = 2, 3$ です。\n\n"
+    "**ポイント**: 因数分解できるかどうかを最初に確認しましょう。",
+    "ヒントです。\n\n"
+    "$$\n\\sum_{k=1}^{n} k = \\frac{n(n+1)}{2}\n$$\n\n"
+    "この公式を使うと、計算がぐっと楽になります。どこに使えるか考えてみましょう。",
+    "【問1】 $\\log_2 8$ の値を求めなさい。\n\n"
+    "【問2】 $\\sin^2 \\theta + \\cos^2 \\theta$ を簡単にしなさい。\n\n"
+    "まずは自力で解いてみてください。",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def _client_for(api_key):
+    """API キーごとのクライアント（genai.configure はプロセス全体のキーを書き換えるので使わない）"""
+    return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+
+class GeminiBackend:
+    def __init__(self, api_key, model_name, system_instruction=None, json_output=False):
+        generation_config = {"response_mime_type": "application/json"} if json_output else None
+        self._model = genai.GenerativeModel(
+            model_name, system_instruction=system_instruction, generation_config=generation_config
+        )
+        # 生徒ごとに別のキーを入力しても混ざらないよう、このモデルをキー専用のクライアントに結び付ける
+        self._model._client = _client_for(api_key)
+
+    def start_chat(self, history):
+        return _GeminiChat(self._model.start_chat(history=history))
+
+    def count_tokens(self, contents):
+        return self._model.count_tokens(contents).total_tokens
+
+    def generate(self, prompt):
+        return self._model.generate_content(prompt).text
+
+
+class _GeminiChat:
+    def __init__(self, chat):
+        self._chat = chat
+
+    def send_message(self, parts, stream=True):
+        """応答のテキストを少しずつ返す"""
+        for chunk in self._chat.send_message(parts, stream=stream):
+            if chunk.text:
+                yield chunk.text
+
+
+class FakeBackend:
+    """入力から決まる応答を、指定した遅延とチャンクの大きさで流すだけのバックエンド"""
+
+    def __init__(self, latency=FAKE_LATENCY, chunk_size=FAKE_CHUNK_SIZE,
+                 chunk_delay=FAKE_CHUNK_DELAY, json_output=False):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.json_output = json_output
+
+    def _pick(self, parts):
+        text = json.dumps([p if isinstance(p, str) else "<image>" for p in parts], ensure_ascii=False)
+        index = int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16) % len(FAKE_RESPONSES)
+        return FAKE_RESPONSES[index]
+
+    def start_chat(self, history):
+        return _FakeChat(self, history)
+
+    def count_tokens(self, contents):
+        return len(json.dumps(contents, ensure_ascii=False, default=str)) // 2
+
+    def generate(self, prompt):
+        time.sleep(self.latency)
+        if not self.json_output:
+            return self._pick([prompt])
+        if "【問題セット】" in prompt:
+            # 答えのキー作成：問の数だけ答えを返す
+            count = max(1, len(re.findall(r"問\s*\d", prompt.split("【問題セット】", 1)[1])))
+            return json.dumps([{"answer": "3", "explanation": "計算すると $3$ です。"}] * count, ensure_ascii=False)
+        # 問題バンク補充：【N問】の数だけ問題を返す
+        match = re.search(r"【(\d+)問】", prompt)
+        count = int(match.group(1)) if match else 1
+        return json.dumps(
+            [{"problem": f"$x + {i} = {i + 3}$ を解きなさい。", "answer": "3", "explanation": f"両辺から ${i}$ を引きます。"}
+             for i in range(1, count + 1)],
+            ensure_ascii=False,
+        )
+
+
+class _FakeChat:
+    def __init__(self, backend, history):
+        self._backend = backend
+        self.history = list(history)
+
+    def send_message(self, parts, stream=True):
+        if isinstance(parts, str):
+            parts = [parts]
+        backend = self._backend
+        text = backend._pick(parts)
+        time.sleep(backend.latency)
+        for start in range(0, len(text), backend.chunk_size):
+            if start:
+                time.sleep(backend.chunk_delay)
+            yield text[start:start + backend.chunk_size]
+
+
+def make_backend(name, api_key=None, model_name=None, system_instruction=None,
+                 json_output=False, fake_options=None):
+    """設定名からバックエンドを作る"""
+    if name == "fake":
+        return FakeBackend(json_output=json_output, **(fake_options or {}))
+    if name == "gemini":
+        return GeminiBackend(api_key, model_name, system_instruction=system_instruction, json_output=json_output)
+    raise ValueError(f"未対応のバックエンドです: {name}（{', '.join(BACKENDS)} のいずれか）")
@@ -0,0 +1,119 @@
+# --- 応答キャッシュ ---
+# 「解答のみ」「解説を見る」「ヒント」などのボタンは決まった文字列を送るため、
+# 同じ会話状態で押し直されたときは前回の応答をそのまま再生できます。
+# 1段目: プロセス内の LRU（st.cache_resource で全セッション共有）
+# 2段目: 任意の SQLite（サイズ上限つき、再起動後も残る）
+# どちらも TTL を過ぎた応答は返しません。
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MEMORY_MAX_ENTRIES = 512
+DISK_TTL_SECONDS = 7 * 24 * 60 * 60
+DISK_MAX_BYTES = 50 * 1024 * 1024
+
+
+def _normalize_message(message):
+    """画像はハッシュ、テキストは前後の空白を除いた形にそろえる"""
+    content = message["content"]
+    if isinstance(content, dict):
+        return [message["role"], content.get("text", "").strip(), content.get("image_hash")]
+    return [message["role"], str(content).strip(), None]
+
+
+def make_cache_key(model_name, system_instruction, messages):
+    """モデル名・役割指示・会話（最後のメッセージを含む）からキーを作る"""
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "system": system_instruction.strip(),
+            "messages": [_normalize_message(m) for m in messages if m["role"] != "system"],
+        },
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, db_path=None, max_entries=MEMORY_MAX_ENTRIES,
+                 ttl_seconds=DISK_TTL_SECONDS, max_bytes=DISK_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            now = time.time()
+            if key in self._memory:
+                value, created = self._memory[key]
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]  # 期限切れ（SQLite 側も期限切れなので下で消える）
+            if self._db is None:
+                return None
+
+            row = self._db.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if now - created > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, value, created)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            now = time.time()
+            self._remember(key, value, now)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed, size)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, now, now, len(value.encode("utf-8"))),
+            )
+            self._evict_disk(now)
+            self._db.commit()
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        """期限切れを消し、サイズ上限を超えていれば古く使われていないものから消す"""
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,133 @@
+# --- 会話履歴の管理（トークン予算つき） ---
+# 毎ターン全履歴を送り直すと、長い学習セッションほどプロンプトが大きくなり
+# 応答開始までの時間とコストが増え続けます。
+# ここでは「直近 N 往復」と「現在の問題セット」だけをそのまま残し、
+# それより古い会話は要約（セッションに保存して少しずつ更新）にまとめます。
+
+RECENT_TURNS = 6            # そのまま残す直近の往復数
+MIN_RECENT_TURNS = 1        # 予算オーバー時でも最低限残す往復数
+HISTORY_TOKEN_BUDGET = 8000 # 送信する履歴＋今回のメッセージの上限トークン数
+SUMMARY_BATCH_TURNS = 4     # 直近の窓からこれだけ溢れたら、まとめて要約に畳む
+
+SUMMARY_STATE_KEY = "history_summary"
+
+SUMMARY_PROMPT = """
+あなたは高校数学の個別指導の記録係です。
+以下の「これまでの要約」に「新しい会話」の内容を反映し、更新した要約だけを出力してください。
+- 扱った単元・問題、生徒のつまずき、正誤、既に伝えたヒントを簡潔に残してください。
+- 数式はLaTeX形式（$マーク）で書いてください。
+- 400字程度に収めてください。
+
+【これまでの要約】
+{summary}
+
+【新しい会話】
+{transcript}
+"""
+
+
+def message_text(message):
+    """メッセージから送信用のテキストだけを取り出す"""
+    content = message["content"]
+    if isinstance(content, dict):
+        text = content.get("text", "")
+        if content.get("transcript"):
+            # 画像は送り直さず、一度だけ作った書き起こしで代用する
+            text += "\n\n【画像の書き起こし】\n" + content["transcript"]
+        return text
+    return str(content)
+
+
+def _fold_into_summary(state, past, cut, generate_text):
+    """past[:cut] が要約に含まれるように、要約を差分だけ更新する"""
+    cached = state.get(SUMMARY_STATE_KEY)
+    if not cached or cached["upto"] > len(past):
+        # 初回、または会話リセット後
+        cached = {"upto": 0, "text": ""}
+
+    if cut > cached["upto"]:
+        transcript = "\n".join(
+            f"{'生徒' if m['role'] == 'user' else '先生'}: {message_text(m)}"
+            for m in past[cached["upto"]:cut]
+        )
+        prompt = SUMMARY_PROMPT.format(summary=cached["text"] or "（なし）", transcript=transcript)
+        cached = {"upto": cut, "text": generate_text(prompt).strip()}
+
+    state[SUMMARY_STATE_KEY] = cached
+    return cached
+
+
+def _latest_problem_set(past, before):
+    """past[:before] の中で最後に出題された問題セットを探す"""
+    for m in reversed(past[:before]):
+        if m.get("kind") == "problem_set":
+            return message_text(m)
+    return None
+
+
+def _assemble(summary_text, problem_set, recent):
+    history = []
+    if summary_text or problem_set:
+        intro = "【これまでの学習の要約】\n" + (summary_text or "（なし）")
+        if problem_set:
+            intro += "\n\n現在取り組んでいる問題は次の通りです。"
+        history.append({"role": "user", "parts": [intro]})
+        history.append({"role": "model", "parts": [problem_set or "承知しました。続けましょう。"]})
+
+    for m in recent:
+        history.append({"role": m["role"], "parts": [message_text(m)]})
+    return history
+
+
+def _cut_for(past, turns, summarized_upto):
+    """直近 turns 往復を残すときの、要約に畳む範囲の終わり"""
+    cut = max(0, len(past) - 2 * turns, summarized_upto)
+    # Gemini の履歴は user から始まる必要があるので、model で始まる場合は1つ手前から残す
+    if 0 < cut < len(past) and past[cut]["role"] != "user":
+        cut -= 1
+    return cut
+
+
+def build_history(messages, current_parts, state, count_tokens, generate_text,
+                  recent_turns=RECENT_TURNS, token_budget=HISTORY_TOKEN_BUDGET):
+    """
+    送信直前のメッセージ（messages[-1] を除いた過去分）から start_chat 用の履歴を作る。
+    count_tokens(contents) はモデルのトークン数計測、generate_text(prompt) は要約用の生成。
+    要約の更新（generate_text の呼び出し）は1回の呼び出しにつき多くても1回。
+    """
+    past = [m for m in messages if m["role"] != "system"]
+    cached = state.get(SUMMARY_STATE_KEY)
+    if cached and cached["upto"] <= len(past):
+        summarized_upto, summary_text = cached["upto"], cached["text"]
+    else:
+        summarized_upto, summary_text = 0, ""
+
+    # 毎ターン要約し直さないよう、直近の窓から SUMMARY_BATCH_TURNS 往復溢れたときだけまとめて畳む
+    cut = summarized_upto
+    if _cut_for(past, recent_turns + SUMMARY_BATCH_TURNS, summarized_upto) > summarized_upto:
+        cut = _cut_for(past, recent_turns, summarized_upto)
+
+    # 予算を超えるなら残す往復数を減らす。新しい要約の長さは今の要約と同程度とみなして数え、
+    # 畳む範囲が決まってから1回だけ要約する
+    candidates = [cut] + [
+        _cut_for(past, turns, summarized_upto) for turns in range(recent_turns - 1, MIN_RECENT_TURNS - 1, -1)
+    ]
+    for i, candidate in enumerate(candidates):
+        if candidate < cut:
+            continue
+        cut = candidate
+        history = _assemble(summary_text, _latest_problem_set(past, cut), past[cut:])
+        if i == len(candidates) - 1:
+            break
+        if count_tokens(history + [{"role": "user", "parts": current_parts}]) <= token_budget:
+            break
+
+    if cut > summarized_upto:
+        summary_text = _fold_into_summary(state, past, cut, generate_text)["text"]
+        history = _assemble(summary_text, _latest_problem_set(past, cut), past[cut:])
+    return history
+
+
+def reset_history(state):
+    """会話リセット時に要約キャッシュも消す"""
+    state.pop(SUMMARY_STATE_KEY, None)
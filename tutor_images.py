@@ -0,0 +1,112 @@
+# --- 画像の取り込み処理 ---
+# スマホ写真（数メガピクセル）や手書きキャンバスをそのまま保存・送信すると、
+# アップロードに時間がかかり、セッション中ずっとメモリを占有します。
+# ここで向き補正・グレースケール化・余白の切り抜き・縮小を行い、
+# 小さな PNG/JPEG バイト列と内容ハッシュだけを残します。
+
+import hashlib
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+IMAGE_MAX_EDGE = 1280     # 長辺の最大ピクセル数
+CONTENT_THRESHOLD = 200   # これより暗い画素を「書き込み」とみなす（0-255）
+CROP_PADDING = 16         # 切り抜き時に残す余白
+JPEG_QUALITY = 85
+THUMBNAIL_WIDTH = 300     # チャット表示の画像幅
+
+STROKE_ALPHA_THRESHOLD = 64  # 手書きキャンバスで「線」とみなす不透明度
+MIN_STROKE_PIXELS = 30       # これ未満ならほぼ空白とみなして送信しない
+
+
+def _crop_to_content(gray):
+    """白地の余白を切り落とす（書き込みが見つからなければそのまま）"""
+    mask = gray.point(lambda p: 255 if p < CONTENT_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return gray
+    left, top, right, bottom = bbox
+    return gray.crop((
+        max(0, left - CROP_PADDING),
+        max(0, top - CROP_PADDING),
+        min(gray.width, right + CROP_PADDING),
+        min(gray.height, bottom + CROP_PADDING),
+    ))
+
+
+def _encode(image):
+    """PNG と JPEG のうち小さい方でエンコードする"""
+    png = io.BytesIO()
+    image.save(png, format="PNG", optimize=True)
+    jpeg = io.BytesIO()
+    image.save(jpeg, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return min(png.getvalue(), jpeg.getvalue(), key=len)
+
+
+def normalize_image(image, max_edge=IMAGE_MAX_EDGE):
+    """PIL 画像を正規化して (バイト列, ハッシュ) を返す"""
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        # 透過部分は白地として扱う
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[3])
+        image = background
+    gray = _crop_to_content(image.convert("L"))
+    gray.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    data = _encode(gray)
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def ingest_image(file, max_edge=IMAGE_MAX_EDGE):
+    """アップロードされたファイルを開いて正規化する"""
+    with Image.open(file) as image:
+        return normalize_image(image, max_edge=max_edge)
+
+
+def canvas_to_image(image_data, padding=CROP_PADDING):
+    """
+    手書きキャンバスの RGBA 配列を、線の部分だけ切り抜いた 1bit PNG にする。
+    線が書かれていない（ほぼ空白の）場合は None を返す。
+    """
+    rgba = np.asarray(image_data)
+    ink = rgba[..., 3] >= STROKE_ALPHA_THRESHOLD
+    if np.count_nonzero(ink) < MIN_STROKE_PIXELS:
+        return None
+
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    top = max(0, rows[0] - padding)
+    bottom = min(ink.shape[0], rows[-1] + 1 + padding)
+    left = max(0, cols[0] - padding)
+    right = min(ink.shape[1], cols[-1] + 1 + padding)
+
+    # 白地に黒線の2値画像（True = 白）
+    binary = Image.fromarray(~ink[top:bottom, left:right])
+    buffer = io.BytesIO()
+    binary.save(buffer, format="PNG", optimize=True)
+    data = buffer.getvalue()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def make_thumbnail(data, width=THUMBNAIL_WIDTH):
+    """チャット表示用の小さな PNG を作る"""
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((width, width * 4), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def image_mime_type(data):
+    """バイト列の先頭から MIME タイプを判定する"""
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    return "image/jpeg"
+
+
+def image_part(data):
+    """Gemini に送るための画像パーツ"""
+    return {"mime_type": image_mime_type(data), "data": data}
@@ -0,0 +1,151 @@
+# --- パフォーマンス計測 ---
+# 1ターン（生徒の送信から応答の表示まで）の各段階の時間・送信量・キャッシュの当たり外れを記録し、
+# JSON Lines のログと Prometheus 形式のテキストファイルに出力します。
+# どこで時間がかかっているかを本番環境で確かめるためのものです。
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+RECENT_TURNS = 20  # デバッグ表示用にセッションに残すターン数
+
+
+class TurnMetrics:
+    """
+    1ターン分の計測値。ターンは生徒が送信した時（submit）に始まり、
+    それより前（画像を選んだり手書きしたりしている間）の時間や再実行は数えない。
+    """
+
+    def __init__(self, session_id, mode=None):
+        self.session_id = session_id
+        self.mode = mode
+        self.submitted = None
+        self.stages = {}    # 段階名 -> 秒
+        self.counts = defaultdict(int)
+        self.payload = {}   # 送信量（履歴のトークン数、画像のバイト数など）
+        self.cache = {}     # キャッシュ名 -> "hit" / "miss"
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def submit(self):
+        """送信された時刻を記録する（2回目以降は何もしない）"""
+        if self.submitted is None:
+            self.submitted = time.time()
+
+    def add_time(self, name, seconds):
+        if self.submitted is not None:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        if self.submitted is not None:
+            self.counts[name] += amount
+
+    def record_payload(self, name, value):
+        self.payload[name] = value
+
+    def record_cache(self, name, hit):
+        self.cache[name] = "hit" if hit else "miss"
+
+    def to_record(self):
+        return {
+            "time": self.submitted,
+            "session_id": self.session_id,
+            "mode": self.mode,
+            "duration_ms": round((time.time() - self.submitted) * 1000, 1),
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "counts": dict(self.counts),
+            "payload": dict(self.payload),
+            "cache": dict(self.cache),
+        }
+
+
+def summary_row(record):
+    """デバッグ表示用に1ターンの記録を1行（平らな dict）にする"""
+    row = {"duration_ms": record["duration_ms"]}
+    row.update({f"{name}_ms": ms for name, ms in record["stages_ms"].items()})
+    row.update(record["payload"])
+    row.update(record["counts"])
+    row.update({f"{name}_cache": outcome for name, outcome in record["cache"].items()})
+    return row
+
+
+class MetricsSink:
+    """全セッションのターンを集計して、ログと Prometheus 形式のファイルに書き出す"""
+
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._turns = defaultdict(int)
+        self._stage_sum = defaultdict(float)
+        self._stage_count = defaultdict(int)
+        self._counts = defaultdict(int)
+        self._payload_sum = defaultdict(float)
+        self._cache_events = defaultdict(int)
+
+    def emit(self, turn):
+        record = turn.to_record()
+        with self._lock:
+            self._turns[record["mode"]] += 1
+            for name, ms in record["stages_ms"].items():
+                self._stage_sum[name] += ms / 1000
+                self._stage_count[name] += 1
+            for name, amount in record["counts"].items():
+                self._counts[name] += amount
+            for name, value in record["payload"].items():
+                self._payload_sum[name] += value
+            for name, outcome in record["cache"].items():
+                self._cache_events[(name, outcome)] += 1
+
+            if self.jsonl_path:
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if self.prometheus_path:
+                # 書きかけのファイルを読まれないよう、一時ファイルから置き換える
+                tmp_path = self.prometheus_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(self._prometheus_text())
+                os.replace(tmp_path, self.prometheus_path)
+        return record
+
+    def _prometheus_text(self):
+        lines = [
+            "# HELP tutor_turns_total Completed tutor turns.",
+            "# TYPE tutor_turns_total counter",
+        ]
+        lines += [f'tutor_turns_total{{mode="{mode}"}} {n}' for mode, n in sorted(self._turns.items())]
+        lines += [
+            "# HELP tutor_stage_seconds Time spent in each stage of a turn.",
+            "# TYPE tutor_stage_seconds summary",
+        ]
+        for name in sorted(self._stage_sum):
+            lines.append(f'tutor_stage_seconds_sum{{stage="{name}"}} {self._stage_sum[name]:.6f}')
+            lines.append(f'tutor_stage_seconds_count{{stage="{name}"}} {self._stage_count[name]}')
+        lines += [
+            "# HELP tutor_events_total Reruns and other per-turn counts.",
+            "# TYPE tutor_events_total counter",
+        ]
+        lines += [f'tutor_events_total{{event="{name}"}} {n}' for name, n in sorted(self._counts.items())]
+        lines += [
+            "# HELP tutor_payload_total Sum of payload sizes (history tokens, image bytes).",
+            "# TYPE tutor_payload_total counter",
+        ]
+        lines += [f'tutor_payload_total{{payload="{name}"}} {v:g}' for name, v in sorted(self._payload_sum.items())]
+        lines += [
+            "# HELP tutor_cache_events_total Cache lookups by cache and outcome.",
+            "# TYPE tutor_cache_events_total counter",
+        ]
+        lines += [
+            f'tutor_cache_events_total{{cache="{name}",outcome="{outcome}"}} {n}'
+            for (name, outcome), n in sorted(self._cache_events.items())
+        ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,58 @@
+# --- 先読み（プリフェッチ） ---
+# 演習モードで問題セットが出た直後、次に押されるのはほぼ
+# 「ヒント」「ギブアップ」「易しく/維持/難しく」のどれかです。
+# これらの応答をセッション専用のスレッドプールで裏で生成しておき、
+# ボタンが押されたらすぐに返します。
+
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+PREFETCH_MAX_WORKERS = 2  # セッションあたりの同時生成数（API 枠を使いすぎないように）
+
+
+class Prefetcher:
+    def __init__(self, max_workers=PREFETCH_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._futures = {}
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        # セッションが破棄されたらスレッドも片付ける
+        weakref.finalize(self, self._executor.shutdown, wait=False, cancel_futures=True)
+
+    def schedule(self, key, generate):
+        """generate(cancel_event) を裏で実行し、結果を key で取り出せるようにする"""
+        with self._lock:
+            if key in self._futures:
+                return
+            self._futures[key] = self._executor.submit(generate, self._cancel_event)
+
+    def take(self, key, wait=True):
+        """
+        key の結果を取り出す（wait なら生成中のものは完了を待つ）。無ければ None。
+        まだ始まっていないものは、他の先読みの後ろで待つより直接作るほうが速いので取り消して None を返す。
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None or (not wait and not future.done()):
+                return None
+            del self._futures[key]
+            if future.cancel():
+                return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def cancel(self, keep=()):
+        """keep 以外の待機中のものは取り消し、生成中のものには中断を知らせる"""
+        with self._lock:
+            kept = {}
+            for key, future in self._futures.items():
+                if key in keep:
+                    kept[key] = future
+                else:
+                    future.cancel()
+            self._futures = kept
+            self._cancel_event.set()
+            self._cancel_event = threading.Event()
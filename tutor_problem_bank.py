@@ -0,0 +1,123 @@
+# --- 問題バンク ---
+# 演習モードの「問題を作成開始」は毎回 LLM で一から問題を作るため、
+# どの生徒も同じような生成を待つことになります。
+# (科目, 単元, 難易度) ごとに問題・答え・解説を SQLite に作り置きしておき、
+# 開始時はここから即座に出題します。残りが少ない単元は裏で補充します。
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+DEFAULT_DIFFICULTY = "標準"
+LOW_WATERMARK = 10    # これを下回ったら補充する
+REFILL_BATCH = 5      # 1回の補充で作る問題数
+
+GENERATION_PROMPT = """
+あなたは日本の高校数学教師です。【{subject}の{topic}】に関する難易度「{difficulty}」の練習問題を【{count}問】作成してください。
+数式は必ずLaTeX形式（$マーク）で書いてください。
+次の形式の JSON 配列だけを出力してください。
+[{{"problem": "問題文", "answer": "最終的な答え（数値または数式のみ）", "explanation": "詳しい解説"}}]
+"""
+
+
+def parse_generated_problems(text):
+    """モデルが返した JSON を (問題, 答え, 解説) のリストにする"""
+    items = json.loads(text)
+    problems = []
+    for item in items:
+        if item.get("problem") and item.get("answer"):
+            problems.append((item["problem"], str(item["answer"]), item.get("explanation", "")))
+    return problems
+
+
+def format_problem_set(problems):
+    """バンクの問題を「問1, 問2...」形式の出題文にする"""
+    lines = [f"**問{i}** {p['problem']}" for i, p in enumerate(problems, 1)]
+    return "\n\n".join(lines) + "\n\n解答を入力してください。"
+
+
+class ProblemBank:
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS problems ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " subject TEXT NOT NULL, topic TEXT NOT NULL, difficulty TEXT NOT NULL,"
+            " problem TEXT NOT NULL, answer TEXT NOT NULL, explanation TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS problems_topic ON problems (subject, topic, difficulty)"
+        )
+        self._db.commit()
+
+        self._refill_queue = queue.Queue()
+        self._refilling = set()
+        threading.Thread(target=self._refill_worker, name="problem-bank-refill", daemon=True).start()
+
+    def add(self, subject, topic, difficulty, problems):
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO problems (subject, topic, difficulty, problem, answer, explanation, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(subject, topic, difficulty, p, a, e, time.time()) for p, a, e in problems],
+            )
+            self._db.commit()
+
+    def count(self, subject, topic, difficulty, exclude=()):
+        where, params = self._where(subject, topic, difficulty, exclude)
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM problems WHERE {where}", params).fetchone()[0]
+
+    def take(self, subject, topic, difficulty, count, exclude=()):
+        """まだ見ていない問題を count 問返す。足りなければ None"""
+        where, params = self._where(subject, topic, difficulty, exclude)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM problems WHERE {where} ORDER BY RANDOM() LIMIT ?", [*params, count]
+            ).fetchall()
+        if len(rows) < count:
+            return None
+        return [dict(row) for row in rows]
+
+    def _where(self, subject, topic, difficulty, exclude):
+        """単元と難易度が一致し、exclude（出題済みの id）に無い問題を選ぶ条件"""
+        exclude = list(exclude)
+        where = "subject = ? AND topic = ? AND difficulty = ?"
+        if exclude:
+            where += f" AND id NOT IN ({','.join('?' * len(exclude))})"
+        return where, [subject, topic, difficulty, *exclude]
+
+    def request_refill(self, subject, topic, difficulty, generate, exclude=()):
+        """
+        残りが少なければ補充を予約する。
+        generate(prompt) はモデルの出力テキストを返す関数（裏のスレッドで呼ばれる）。
+        """
+        key = (subject, topic, difficulty)
+        if self.count(subject, topic, difficulty, exclude) >= LOW_WATERMARK:
+            return
+        with self._lock:
+            if key in self._refilling:
+                return
+            self._refilling.add(key)
+        self._refill_queue.put((key, generate))
+
+    def _refill_worker(self):
+        while True:
+            key, generate = self._refill_queue.get()
+            subject, topic, difficulty = key
+            try:
+                prompt = GENERATION_PROMPT.format(
+                    subject=subject, topic=topic, difficulty=difficulty, count=REFILL_BATCH
+                )
+                self.add(subject, topic, difficulty, parse_generated_problems(generate(prompt)))
+            except Exception:
+                # 補充に失敗しても出題は LLM に任せればよいので、ここでは無視する
+                pass
+            finally:
+                with self._lock:
+                    self._refilling.discard(key)
@@ -0,0 +1,205 @@
+# --- リクエストの流量制御 ---
+# クラス全員が1つの API キーを共有すると、同じタイミングでの集中アクセスで
+# 429（クォータ超過）になりがちです。プロセス全体で1つのスケジューラを共有し、
+# RPM/TPM のトークンバケット、同時実行数の上限、セッションごとの公平な順番待ち、
+# ジッター付き指数バックオフでの再試行を行います。
+
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from google.api_core import exceptions as api_exceptions
+
+DEFAULT_RPM = 10             # 1分あたりのリクエスト数の上限
+DEFAULT_TPM = 250_000        # 1分あたりのトークン数の上限
+DEFAULT_MAX_CONCURRENT = 4   # 同時に流すリクエスト数
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0           # 秒
+BACKOFF_CAP = 30.0           # 秒
+OUTPUT_TOKEN_ALLOWANCE = 1000  # 応答分として見込んでおくトークン数
+IMAGE_TOKENS = 258
+BACKGROUND_RESERVED_SLOTS = 1     # 先読みなどが使わずに残しておく同時実行枠
+BACKGROUND_RESERVED_REQUESTS = 2  # 先読みなどが使わずに残しておく RPM の枠
+CANCEL_POLL_SECONDS = 0.5         # 取り消せるリクエストが、待っている間に取り消しを確かめる間隔
+
+# 応答が途中で切れたときに、続きから書いてもらうための指示
+RESUME_PROMPT = "通信が途中で切れました。直前のあなたの回答の続きから書いてください（既に書いた部分は繰り返さないでください）。"
+
+RETRYABLE_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.TooManyRequests,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.DeadlineExceeded,
+)
+
+
+def estimate_tokens(parts):
+    """送信内容のおおよそのトークン数（日本語は1文字あたり0.5トークン程度で見積もる）"""
+    total = OUTPUT_TOKEN_ALLOWANCE
+    for part in parts:
+        if isinstance(part, str):
+            total += len(part) // 2 + 1
+        else:
+            total += IMAGE_TOKENS
+    return total
+
+
+def backoff_delay(attempt):
+    """full jitter の指数バックオフ"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class _TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """amount を使えるようになるまでの秒数"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class RequestCancelled(Exception):
+    """枠を待っている間にリクエストが取り消された"""
+
+
+class RequestScheduler:
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, max_concurrent=DEFAULT_MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self._requests = _TokenBucket(rpm)
+        self._tokens = _TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # session_id -> 順番待ちのチケット（先頭のセッションから順に処理）
+        self._background = OrderedDict()  # 先読み・要約など、生徒が待っていないリクエスト
+        self._active = 0
+
+    def _position(self, session_id, ticket, background):
+        """自分より前にいるリクエストのおおよその数（セッション間は1件ずつ交互に進む）"""
+        queues = self._background if background else self._queues
+        sessions = list(queues)
+        own_index = queues[session_id].index(ticket)
+        position = sessions.index(session_id) + own_index * len(sessions)
+        if background:
+            position += sum(len(queue) for queue in self._queues.values())
+        return position
+
+    def _start_delay(self, session_id, ticket, tokens, background):
+        """今すぐ始められるなら 0、そうでなければ次に確かめるまでの秒数"""
+        queues = self._background if background else self._queues
+        is_next = next(iter(queues)) == session_id and queues[session_id][0] is ticket
+        max_active = self.max_concurrent
+        requests = 1
+        if background:
+            # 生徒の応答が待っている間は進まず、同時実行枠と RPM も少し残しておく
+            is_next = is_next and not self._queues
+            max_active = max(1, self.max_concurrent - BACKGROUND_RESERVED_SLOTS)
+            requests += BACKGROUND_RESERVED_REQUESTS
+        if not is_next or self._active >= max_active:
+            return 0.5
+        return max(self._requests.wait_time(requests), self._tokens.wait_time(tokens))
+
+    def acquire(self, session_id, tokens, on_wait=None, background=False, cancelled=None):
+        """
+        順番と枠が空くまで待つ。on_wait(順番) は待っている間に（ロックの外で）呼ばれる。
+        background のリクエストは、生徒が待っているリクエストが無いときだけ進む。
+        cancelled() が True を返したら、枠を使わずに RequestCancelled を送出する。
+        """
+        ticket = object()
+        queues = self._background if background else self._queues
+        with self._cond:
+            queues.setdefault(session_id, deque()).append(ticket)
+        last_position = None
+        try:
+            while True:
+                with self._cond:
+                    if cancelled and cancelled():
+                        raise RequestCancelled()
+                    delay = self._start_delay(session_id, ticket, tokens, background)
+                    if delay == 0:
+                        self._requests.consume(1)
+                        self._tokens.consume(tokens)
+                        self._active += 1
+                        return
+                    position = self._position(session_id, ticket, background)
+                    if not on_wait or position == last_position:
+                        self._cond.wait(timeout=min(delay, CANCEL_POLL_SECONDS) if cancelled else delay)
+                        continue
+                # 表示の更新（Streamlit への書き込み）で他のセッションを待たせないよう、ロックを離してから呼ぶ
+                on_wait(position)
+                last_position = position
+        finally:
+            with self._cond:
+                queue = queues[session_id]
+                queue.remove(ticket)
+                # 処理したセッションは最後尾に回して、他のセッションに順番を譲る
+                queues.pop(session_id)
+                if queue:
+                    queues[session_id] = queue
+                self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, session_id, tokens, on_wait=None, background=False, cancelled=None):
+        self.acquire(session_id, tokens, on_wait, background, cancelled)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def call(self, session_id, tokens, func, on_retry=None, background=False):
+        """func() を枠の中で実行し、一時的なエラーならバックオフして再試行する"""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with self.slot(session_id, tokens, background=background):
+                    return func()
+            except RETRYABLE_ERRORS:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                if on_retry:
+                    on_retry(attempt + 1, delay)
+                time.sleep(delay)
+
+    def stream(self, session_id, tokens, open_stream, on_wait=None, on_retry=None, background=False,
+               cancelled=None):
+        """
+        open_stream(これまでに受け取った文章) が返すテキストのチャンクを流す。
+        途中でエラーになったら、バックオフしてから受け取った所の続きを要求する。
+        cancelled は acquire と同じ（枠を待っている間に取り消されたら、リクエストを送らない）。
+        """
+        received = ""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with self.slot(session_id, tokens, on_wait, background, cancelled):
+                    for text in open_stream(received):
+                        received += text
+                        yield text
+                return
+            except RETRYABLE_ERRORS:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                if on_retry:
+                    on_retry(attempt + 1, delay)
+                time.sleep(delay)
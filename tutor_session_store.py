@@ -0,0 +1,86 @@
+# --- 会話の保存 ---
+# 会話は st.session_state にしか無く、再読み込みで消えるうえ、タブごとに全画像をメモリに抱えていました。
+# ここでは SQLite に
+#   - セッションごとの追記専用のメッセージログ
+#   - 画像の本体（ハッシュをキーに1回だけ保存。セッションをまたいで重複しない）
+# を保存します。メッセージには画像のハッシュだけを残し、本体は表示・送信のときに読み込みます。
+# 後からメッセージに付け足す情報（答えのキー・画像の書き起こし）も、上書きせず更新として追記します。
+
+import json
+import sqlite3
+import threading
+import time
+
+
+class SessionConflict(Exception):
+    """同じセッションの同じ番号に、別のタブが先にメッセージを書き込んでいた"""
+
+
+class SessionStore:
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " hash TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " session_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, created REAL NOT NULL,"
+            " PRIMARY KEY (session_id, seq))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS updates ("
+            " session_id TEXT NOT NULL, seq INTEGER NOT NULL, fields TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def put_blob(self, image_hash, data):
+        """画像を保存する（同じハッシュが既にあれば何もしない）"""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO blobs (hash, data, size, created) VALUES (?, ?, ?, ?)",
+                (image_hash, sqlite3.Binary(data), len(data), time.time()),
+            )
+            self._db.commit()
+
+    def get_blob(self, image_hash):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM blobs WHERE hash = ?", (image_hash,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def append(self, session_id, seq, message):
+        """seq 番目のメッセージをログに追記する（同じ番号が既にあれば SessionConflict）"""
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT INTO messages (session_id, seq, message, created) VALUES (?, ?, ?, ?)",
+                    (session_id, seq, json.dumps(message, ensure_ascii=False), time.time()),
+                )
+            except sqlite3.IntegrityError:
+                raise SessionConflict(f"{session_id} の {seq} 番目は既に書き込まれています")
+            self._db.commit()
+
+    def update(self, session_id, seq, fields):
+        """記録済みの seq 番目のメッセージに付け足した項目を追記する"""
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO updates (session_id, seq, fields, created) VALUES (?, ?, ?, ?)",
+                (session_id, seq, json.dumps(fields, ensure_ascii=False), time.time()),
+            )
+            self._db.commit()
+
+    def load(self, session_id):
+        """セッションのメッセージを順に返す（更新を反映済み、画像はハッシュのまま）"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+            updates = self._db.execute(
+                "SELECT seq, fields FROM updates WHERE session_id = ? ORDER BY rowid", (session_id,)
+            ).fetchall()
+        messages = [json.loads(message) for (message,) in rows]
+        for seq, fields in updates:
+            if seq < len(messages):
+                messages[seq].update(json.loads(fields))
+        return messages
@@ -0,0 +1,78 @@
+# --- ストリーミング表示 ---
+# チャンクが届くたびに全文を markdown し直すと、応答が長いほど再描画が重くなります
+# （長さの2乗に比例）。ここでは一定間隔でまとめて描画し、
+# 段落が確定したら固定して、まだ書きかけの最後の段落だけを描き直します。
+# 閉じていない $...$ の数式は途中まで描画しません。
+
+import re
+import time
+
+RENDER_INTERVAL = 0.08  # 描画の間隔（秒）
+
+_FENCE = re.compile(r"^```", re.MULTILINE)
+
+
+def _split_committed(text):
+    """確定した段落（空行で区切られ、数式・コードブロックの外にあるもの）と残りに分ける"""
+    cut = 0
+    for match in re.finditer(r"\n\s*\n", text):
+        head = text[:match.end()]
+        # $$...$$ やコードブロックの途中で切らない
+        if head.count("$$") % 2 == 0 and len(_FENCE.findall(head)) % 2 == 0:
+            cut = match.end()
+    return text[:cut], text[cut:]
+
+
+def _safe_tail(text):
+    """閉じていない数式（$$...$$ / $...$）の手前までにする"""
+    if text.count("$$") % 2 == 1:
+        text = text[:text.rfind("$$")]
+    dollars = [m.start() for m in re.finditer(r"(?<!\\)\$", text)]
+    if len(dollars) % 2 == 1:
+        return text[:dollars[-1]]
+    return text
+
+
+class StreamRenderer:
+    def __init__(self, container, interval=RENDER_INTERVAL):
+        self._container = container
+        self._interval = interval
+        self._tail = container.empty()
+        self._pending = ""
+        self._shown = ""
+        self._last_render = 0.0
+        self.text = ""
+        self.render_seconds = 0.0  # markdown の描画にかかった合計時間（計測用）
+
+    def feed(self, chunk):
+        """チャンクを追加する（描画は interval ごと）"""
+        self.text += chunk
+        self._pending += chunk
+        if time.monotonic() - self._last_render >= self._interval:
+            self._render(final=False)
+
+    def finish(self):
+        """最後まで描画する"""
+        self._render(final=True)
+        return self.text
+
+    def _render(self, final):
+        started = time.perf_counter()
+        self._last_render = time.monotonic()
+        if final:
+            committed, tail = "", self._pending
+        else:
+            committed, tail = _split_committed(self._pending)
+
+        if committed:
+            # 確定した段落は今の枠に書いて固定し、次の枠を下に作る
+            self._tail.markdown(committed)
+            self._tail = self._container.empty()
+            self._pending = tail
+            self._shown = ""
+
+        shown = tail if final else _safe_tail(tail)
+        if shown.strip() and shown != self._shown:
+            self._tail.markdown(shown)
+            self._shown = shown
+        self.render_seconds += time.perf_counter() - started
@@ -0,0 +1,34 @@
+# --- 画像の書き起こし ---
+# 履歴には画像を送り直さず、テキストだけを載せています。そのままでは
+# 「さっきの写真の問題の(2)は？」のような質問で問題の中身が分からなくなるため、
+# 画像ごとに一度だけ LaTeX/テキストに書き起こし、履歴では画像の代わりに使います。
+# 書き起こしは画像のハッシュをキーに応答キャッシュへ保存するので、同じ画像は二度書き起こしません。
+
+import hashlib
+
+from tutor_images import image_part
+
+TRANSCRIBE_PROMPT = """
+この画像に書かれている数学の問題・式・解答を、そのまま書き起こしてください。
+- 数式はLaTeX形式（$マーク）で書いてください。
+- 図やグラフは、読み取れる情報（座標・長さ・角度など）を文章で説明してください。
+- 問題を解いたり、説明を加えたりしないでください。書き起こした内容だけを出力してください。
+"""
+
+
+def transcript_cache_key(image_hash):
+    return hashlib.sha256(f"transcript:{image_hash}".encode("utf-8")).hexdigest()
+
+
+def transcribe_image(image_hash, load_image, cache, generate):
+    """
+    画像を書き起こしたテキストを返す（キャッシュにあればそれを使う）。
+    load_image() は画像のバイト列を返す関数（キャッシュに無いときだけ呼ぶ）、
+    generate(parts) は画像を含む内容からテキストを生成する関数。
+    """
+    key = transcript_cache_key(image_hash)
+    transcript = cache.get(key)
+    if transcript is None:
+        transcript = generate([TRANSCRIBE_PROMPT, image_part(load_image())]).strip()
+        cache.put(key, transcript)
+    return transcript